@@ -0,0 +1,155 @@
+import load
+import locations
+from progressbar import progressbar
+import sqlite3
+
+'''sqlite catalog of programs, episodes and segments
+
+the program files in locations.program_directory are ingested one at a time
+into an indexed sqlite database (locations.catalog_filename)
+queries return iterators of dicts, so subsets can be selected without
+loading the corpus, e.g. all clean train segments of a program longer than
+10 seconds:
+    catalog = Catalog()
+    catalog.segments(name = name, split = 'train', min_duration = 10,
+        clean = True)
+'''
+
+schema = '''
+CREATE TABLE IF NOT EXISTS programs (
+    name TEXT PRIMARY KEY,
+    n_episodes INTEGER,
+    n_segments INTEGER,
+    total_duration REAL,
+    min_levenshtein_ratio REAL
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    name TEXT,
+    identifier TEXT,
+    n_segments INTEGER,
+    total_duration REAL,
+    PRIMARY KEY (name, identifier)
+);
+CREATE TABLE IF NOT EXISTS segments (
+    name TEXT,
+    identifier TEXT,
+    segment_id TEXT,
+    audio_filepath TEXT,
+    text TEXT,
+    duration REAL,
+    org_split TEXT,
+    tar_filename TEXT,
+    org_start REAL,
+    org_end REAL,
+    ngram_ratio REAL,
+    levenshtein_ratio REAL,
+    PRIMARY KEY (name, identifier, segment_id)
+);
+CREATE INDEX IF NOT EXISTS segments_split_duration
+    ON segments (org_split, duration);
+CREATE INDEX IF NOT EXISTS segments_ngram_ratio ON segments (ngram_ratio);
+CREATE INDEX IF NOT EXISTS segments_tar_filename ON segments (tar_filename);
+'''
+
+# the column names are the keys of the segments in the program files
+# so query results can be used as segment dicts (e.g. in nemo_manifest)
+segment_columns = ['name', 'identifier', 'segment_id', 'audio_filepath',
+    'text', 'duration', 'org_split', 'tar_filename', 'org_start', 'org_end',
+    'ngram_ratio', 'levenshtein_ratio']
+
+def _dict_factory(cursor, row):
+    return {c[0]: v for c, v in zip(cursor.description, row)}
+
+class Catalog:
+    def __init__(self, filename = None):
+        if filename is None:
+            filename = locations.catalog_filename
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.row_factory = _dict_factory
+        self.connection.executescript(schema)
+
+    def __repr__(self):
+        n = self.connection.execute(
+            'SELECT COUNT(*) AS n FROM segments').fetchone()['n']
+        return f"<Catalog {self.filename} {n} segments>"
+
+    def close(self):
+        self.connection.close()
+
+    def ingest_program(self, program, commit = True):
+        '''add or replace a program (dict from locations.program_directory)
+        with its episodes and segments'''
+        name = program['name']
+        c = self.connection
+        c.execute('DELETE FROM segments WHERE name = ?', (name,))
+        c.execute('DELETE FROM episodes WHERE name = ?', (name,))
+        c.execute('INSERT OR REPLACE INTO programs VALUES (?, ?, ?, ?, ?)',
+            (name, program['n_episodes'], program['n_segments'],
+            program['total_duration'], program.get('min_levenshtein_ratio')))
+        for identifier, episode in program['episodes'].items():
+            c.execute('INSERT INTO episodes VALUES (?, ?, ?, ?)', (name,
+                identifier, len(episode['segments']),
+                episode['total_duration']))
+            c.executemany('INSERT INTO segments VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (_segment_to_row(s) for s in episode['segments']))
+        if commit: c.commit()
+
+    def ingest_all(self, names = None):
+        '''ingest the program files, default all program names'''
+        if names is None:
+            names = load.load_program_names()
+        for name in progressbar(names):
+            self.ingest_program(load.load_program(name), commit = False)
+        self.connection.commit()
+
+    def query(self, sql, parameters = ()):
+        '''run sql and return an iterator of row dicts'''
+        return self.connection.execute(sql, parameters)
+
+    def programs(self):
+        return self.query('SELECT * FROM programs ORDER BY name')
+
+    def episodes(self, name = None):
+        if name is None:
+            return self.query('SELECT * FROM episodes ORDER BY name, identifier')
+        return self.query('SELECT * FROM episodes WHERE name = ? '
+            'ORDER BY identifier', (name,))
+
+    def segments(self, name = None, identifier = None, split = None,
+        min_duration = None, max_duration = None, clean = None,
+        max_coverage = 0.3, min_levenshtein_ratio = None,
+        tar_filename = None, limit = None):
+        '''return an iterator of segment dicts matching all given criteria
+        clean   True: ngram_ratio <= max_coverage, False: hallucinations
+                (ngram_ratio > max_coverage), None: no selection
+                segments without text (ngram_ratio is NULL) are never clean
+        '''
+        where, parameters = [], []
+        for column, operator, value in [('name', '=', name),
+            ('identifier', '=', identifier), ('org_split', '=', split),
+            ('duration', '>=', min_duration), ('duration', '<', max_duration),
+            ('levenshtein_ratio', '>=', min_levenshtein_ratio),
+            ('tar_filename', '=', tar_filename)]:
+            if value is None: continue
+            where.append(f'{column} {operator} ?')
+            parameters.append(value)
+        if clean is not None:
+            where.append('ngram_ratio <= ?' if clean else 'ngram_ratio > ?')
+            parameters.append(max_coverage)
+        sql = 'SELECT * FROM segments'
+        if where: sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY name, identifier, CAST(segment_id AS INTEGER)'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        return self.query(sql, parameters)
+
+    def total_duration(self, **kwargs):
+        '''total duration in seconds of the segments selected by kwargs
+        (see segments)'''
+        return sum(s['duration'] for s in self.segments(**kwargs))
+
+def _segment_to_row(segment):
+    return tuple(segment.get(k) for k in segment_columns)
@@ -108,7 +108,7 @@ import json
 import os
 import random
 import tarfile
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 from dataclasses import dataclass, field
 from datetime import datetime
 from io import BytesIO
@@ -128,6 +128,53 @@ try:
 except (ImportError, ModuleNotFoundError, FileNotFoundError):
     DALI_INDEX_SCRIPT_AVAILABLE = False
 
+try:
+    import json_codec
+
+    json_loads = json_codec.loads
+except ImportError:
+    json_codec = None
+    json_loads = json.loads
+
+def write_manifest_entries(entries, fout):
+    """Write manifest entries as json lines, batched through json_codec when available."""
+    if json_codec is not None:
+        json_codec.write_lines(entries, fout, ensure_ascii=False)
+        return
+    for entry in entries:
+        json.dump(entry, fout, ensure_ascii=False)
+        fout.write("\n")
+
+
+class SourceTarReader:
+    """
+    Reads single members of source tars at the `[tar path, data offset, size]` resolved by
+    `nemo_manifest.make_source_tar_mapping`, so audio can be copied into shards without extracting it to disk
+    first and without loading the tar indices. At most `max_open` source tars are kept open.
+    """
+
+    def __init__(self, max_open: int = 64):
+        self.max_open = max_open
+        self.fds = OrderedDict()
+
+    def read(self, tar_filepath: str, data_offset: int, size: int) -> bytes:
+        if tar_filepath in self.fds:
+            self.fds.move_to_end(tar_filepath)
+        else:
+            if len(self.fds) >= self.max_open:
+                _, fd = self.fds.popitem(last=False)
+                os.close(fd)
+            self.fds[tar_filepath] = os.open(tar_filepath, os.O_RDONLY)
+        data = os.pread(self.fds[tar_filepath], size, data_offset)
+        if len(data) != size:
+            raise EOFError(f"Could only read {len(data)} of {size} bytes at offset {data_offset} of {tar_filepath}!")
+        return data
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
+
 
 @dataclass
 class ASRTarredDatasetConfig:
@@ -141,6 +188,7 @@ class ASRTarredDatasetConfig:
     shard_manifests: bool = True
     keep_files_together: bool = False
     force_codec: Optional[str] = None
+    source_tar_mapping: Optional[str] = None
     use_lhotse: bool = False
     use_bucketing: bool = False
     num_buckets: Optional[int] = None
@@ -181,8 +229,12 @@ class ASRTarredDatasetBuilder:
     together and constructs manifests for them.
     """
 
+    # Maximum length in seconds of the audio decoded at once when cutting slices from a long recording.
+    slice_window_duration = 600.0
+
     def __init__(self):
         self.config = None
+        self._encoder_cache = {}
 
     def configure(self, config: ASRTarredDatasetConfig):
         """
@@ -276,6 +328,9 @@ class ASRTarredDatasetBuilder:
         if dry_run:
             return
 
+        if config.source_tar_mapping is not None and not only_manifests:
+            self._attach_source_tars(entries, config.source_tar_mapping)
+
         if len(entries) == 0:
             print("No tarred dataset was created as there were 0 valid samples after filtering!")
             return
@@ -331,9 +386,7 @@ class ASRTarredDatasetBuilder:
                 shard_id = manifest[0]["shard_id"]
                 new_manifest_shard_path = os.path.join(sharded_manifests_dir, f"manifest_{shard_id}.json")
                 with open(new_manifest_shard_path, "w", encoding="utf-8") as m2:
-                    for entry in manifest:
-                        json.dump(entry, m2, ensure_ascii=False)
-                        m2.write("\n")
+                    write_manifest_entries(manifest, m2)
 
         # Flatten the list of list of entries to a list of entries
         new_entries = [sample for manifest in new_entries_list for sample in manifest]
@@ -344,9 +397,7 @@ class ASRTarredDatasetBuilder:
         # Write manifest
         new_manifest_path = os.path.join(target_dir, "tarred_audio_manifest.json")
         with open(new_manifest_path, "w", encoding="utf-8") as m2:
-            for entry in new_entries:
-                json.dump(entry, m2, ensure_ascii=False)
-                m2.write("\n")
+            write_manifest_entries(new_entries, m2)
 
         # Write metadata (default metadata for new datasets)
         new_metadata_path = os.path.join(target_dir, "metadata.yaml")
@@ -492,6 +543,9 @@ class ASRTarredDatasetBuilder:
         if dry_run:
             return
 
+        if config.source_tar_mapping is not None and not only_manifests:
+            self._attach_source_tars(entries, config.source_tar_mapping)
+
         start_indices = []
         end_indices = []
         shard_indices = []
@@ -523,9 +577,7 @@ class ASRTarredDatasetBuilder:
                 shard_id = manifest[0]["shard_id"]
                 new_manifest_shard_path = os.path.join(sharded_manifests_dir, f"manifest_{shard_id}.json")
                 with open(new_manifest_shard_path, "w", encoding="utf-8") as m2:
-                    for entry in manifest:
-                        json.dump(entry, m2, ensure_ascii=False)
-                        m2.write("\n")
+                    write_manifest_entries(manifest, m2)
 
         # Flatten the list of list of entries to a list of entries
         new_entries = [sample for manifest in new_entries_list for sample in manifest]
@@ -542,14 +594,10 @@ class ASRTarredDatasetBuilder:
         new_manifest_path = os.path.join(target_dir, f"tarred_audio_manifest_version_{new_version}.json")
         with open(new_manifest_path, "w", encoding="utf-8") as m2:
             # First write all the entries of base manifest
-            for entry in base_entries:
-                json.dump(entry, m2, ensure_ascii=False)
-                m2.write("\n")
+            write_manifest_entries(base_entries, m2)
 
             # Finally write the new entries
-            for entry in new_entries:
-                json.dump(entry, m2, ensure_ascii=False)
-                m2.write("\n")
+            write_manifest_entries(new_entries, m2)
 
         # Preserve historical metadata
         base_metadata = metadata
@@ -585,7 +633,7 @@ class ASRTarredDatasetBuilder:
         filtered_duration = 0.0
         with open(manifest_path, "r", encoding="utf-8") as m:
             for line in m:
-                entry = json.loads(line)
+                entry = json_loads(line)
                 audio_key = "audio_filepath" if "audio_filepath" in entry else "audio_file"
                 if config.slice_with_offset and "offset" not in entry:
                     raise KeyError(f"Manifest entry does not contain 'offset' field, but '--slice_with_offset' is enabled: {entry}")
@@ -608,34 +656,146 @@ class ASRTarredDatasetBuilder:
 
         return entries, total_duration, filtered_entries, filtered_duration
 
-    def _write_to_tar(self, tar, audio_filepath: str, squashed_filename: str, duration: float = None, offset: float = 0) -> None:
+    def _attach_source_tars(self, entries, source_tar_mapping: str):
+        """Adds the `[tar path, data offset, size]` of each entry (key `source_tar`) from the mapping file made by
+        `nemo_manifest.make_source_tar_mapping`, the key is removed again in `_create_shard`."""
+        with open(source_tar_mapping, "r", encoding="utf-8") as f:
+            mapping = json_loads(f.read())
+        for entry in entries:
+            if entry["audio_filepath"] not in mapping:
+                raise KeyError(f"No source tar for {entry['audio_filepath']} in {source_tar_mapping}")
+            entry["source_tar"] = mapping[entry["audio_filepath"]]
+        print(f"Reading audio of {len(entries)} entries from source tars.")
+
+    def _write_to_tar(self, tar, audio_filepath: str, squashed_filename: str, duration: float = None, offset: float = 0, data: bytes = None) -> None:
         codec = self.config.force_codec
         to_transcode = not (codec is None or audio_filepath.endswith(f".{codec}"))
         to_crop = not (duration is None and offset == 0)
 
         if not to_crop and not to_transcode:
-            # Add existing file without transcoding, trimming, or re-encoding.
-            tar.add(audio_filepath, arcname=squashed_filename)
+            if data is None:
+                # Add existing file without transcoding, trimming, or re-encoding.
+                tar.add(audio_filepath, arcname=squashed_filename)
+            else:
+                # Byte copy of the source tar member.
+                ti = tarfile.TarInfo(squashed_filename)
+                ti.size = len(data)
+                tar.addfile(ti, BytesIO(data))
             return
 
-        # Standard processing: read, trim, and transcode the audio file
-        with soundfile.SoundFile(audio_filepath) as f:
-            sampling_rate = f.samplerate
+        # Standard processing: open the audio once to read the sample rate, seek and decode.
+        # The audio is either a file on disk or the bytes of a source tar member.
+        with soundfile.SoundFile(audio_filepath if data is None else BytesIO(data)) as f:
+            audio, sampling_rate = self._read_slice(f, offset, duration)
+            source_format = f.format
+
+        self._add_encoded_to_tar(tar, audio, sampling_rate, squashed_filename, source_format)
 
-        # Trim audio based on offset and duration.
+    @staticmethod
+    def _read_slice(f: soundfile.SoundFile, offset: float = 0, duration: float = None):
+        """Seeks to `offset` and decodes `duration` seconds (until the end if None) from an open file.
+        16 bit PCM is decoded to int16 (exact), everything else to float32."""
+        sampling_rate = f.samplerate
         start_sample = int(offset * sampling_rate)
         num_frames = int(duration * sampling_rate) if duration else -1
-        audio, sampling_rate = soundfile.read(audio_filepath, start=start_sample, frames=num_frames)
+        if start_sample:
+            f.seek(start_sample)
+        return f.read(frames=num_frames, dtype=ASRTarredDatasetBuilder._decode_dtype(f)), sampling_rate
+
+    @staticmethod
+    def _decode_dtype(f: soundfile.SoundFile) -> str:
+        """16 bit PCM is decoded to int16 (exact), everything else to float32."""
+        return "int16" if f.subtype == "PCM_16" else "float32"
+
+    @staticmethod
+    def _slice_windows(spans, max_frames: int):
+        """Groups `(start, frames, index)` spans sorted on start into windows of at most `max_frames` frames
+        (a single longer span gets its own window)."""
+        window, window_end = [], 0
+        for span in spans:
+            end = span[0] + span[1]
+            if window and max(window_end, end) - window[0][0] > max_frames:
+                yield window
+                window, window_end = [], 0
+            window.append(span)
+            window_end = max(window_end, end)
+        if window:
+            yield window
+
+    def _write_slices_to_tar(self, tar, slices, source_tars: SourceTarReader = None) -> None:
+        """
+        Writes `(audio_filepath, to_write, duration, offset, source_tar)` slices to the tar archive in the given order.
 
-        # Determine codec parameters.
-        if codec is not None:
-            if codec == "opus":
+        The slices are grouped by recording, each recording is opened once and decoded in windows of at most
+        `slice_window_duration` seconds that cover its slices, and every slice is cut from the decoded window.
+        The sample positions match `_read_slice`, so the output equals decoding each slice on its own.
+        A slice is added to the tar as soon as all slices before it are encoded, so only out of order slices are
+        held in memory (none when the slices of a recording are contiguous, as with `keep_files_together`).
+        """
+        recordings = defaultdict(list)
+        for i, audio_slice in enumerate(slices):
+            recordings[audio_slice[0]].append(i)
+
+        encoded = {}
+        next_index = 0
+        for audio_filepath, indices in tqdm(recordings.items(), desc="Decoding recordings.."):
+            source_tar = slices[indices[0]][4]
+            data = source_tars.read(*source_tar) if source_tar is not None else None
+            with soundfile.SoundFile(audio_filepath if data is None else BytesIO(data)) as f:
+                sampling_rate = f.samplerate
+                source_format = f.format
+                spans = []
+                for i in indices:
+                    _, _, duration, offset, _ = slices[i]
+                    start = int(offset * sampling_rate)
+                    frames = int(duration * sampling_rate) if duration else f.frames - start
+                    spans.append((start, frames, i))
+                spans.sort()
+                max_frames = int(self.slice_window_duration * sampling_rate)
+                for window in self._slice_windows(spans, max_frames):
+                    window_start = window[0][0]
+                    window_end = max(start + frames for start, frames, _ in window)
+                    f.seek(window_start)
+                    audio = f.read(frames=window_end - window_start, dtype=self._decode_dtype(f))
+                    for start, frames, i in window:
+                        audio_slice = audio[start - window_start : start - window_start + frames]
+                        encoded[i] = self._encode_audio(audio_slice, sampling_rate, slices[i][1], source_format)
+                        while next_index in encoded:
+                            self._add_buffer_to_tar(tar, *encoded.pop(next_index))
+                            next_index += 1
+                    del audio
+
+    def _encoder_settings(self, source_format: str):
+        """Returns the output extension and `soundfile.write` arguments, cached per source format."""
+        codec = self.config.force_codec
+        key = (codec, source_format)
+        if key not in self._encoder_cache:
+            if codec is None:
+                codec = source_format.lower()
+                kwargs = {"format": codec}
+            elif codec == "opus":
                 kwargs = {"format": "ogg", "subtype": "opus"}
             else:
                 kwargs = {"format": codec}
-        else:
-            codec = soundfile.info(audio_filepath).format.lower()
-            kwargs = {"format": codec}
+            self._encoder_cache[key] = (codec, kwargs)
+        return self._encoder_cache[key]
+
+    def _add_encoded_to_tar(self, tar, audio, sampling_rate: int, squashed_filename: str, source_format: str) -> None:
+        """Encodes decoded audio in memory and adds it to the tar archive."""
+        encoded_squashed_filename, encoded_audio = self._encode_audio(audio, sampling_rate, squashed_filename, source_format)
+        self._add_buffer_to_tar(tar, encoded_squashed_filename, encoded_audio)
+
+    @staticmethod
+    def _add_buffer_to_tar(tar, filename: str, buffer: BytesIO) -> None:
+        """Adds an in-memory file to the tar archive."""
+        ti = tarfile.TarInfo(filename)
+        ti.size = buffer.getbuffer().nbytes
+        buffer.seek(0)
+        tar.addfile(ti, buffer)
+
+    def _encode_audio(self, audio, sampling_rate: int, squashed_filename: str, source_format: str):
+        """Encodes decoded audio in memory, returns the archive filename and the encoded buffer."""
+        codec, kwargs = self._encoder_settings(source_format)
 
         # Transcode and write audio to tar.
         encoded_audio = BytesIO()
@@ -643,12 +803,7 @@ class ASRTarredDatasetBuilder:
 
         # Generate filename with the appropriate extension.
         encoded_squashed_filename = f"{squashed_filename.split('.')[0]}.{codec}"
-
-        # Add the in-memory audio file to the tar archive.
-        ti = tarfile.TarInfo(encoded_squashed_filename)
-        encoded_audio.seek(0)
-        ti.size = len(encoded_audio.getvalue())
-        tar.addfile(ti, encoded_audio)
+        return encoded_squashed_filename, encoded_audio
 
     def _create_shard(self, entries, target_dir, shard_id, manifest_folder: str = None, only_manifests: bool = False):
         """Creates a tarball containing the audio files from `entries`."""
@@ -660,11 +815,16 @@ class ASRTarredDatasetBuilder:
         tar_filepath = os.path.join(target_dir, f"audio_{shard_id}.tar")
         if not only_manifests:
             tar = tarfile.open(tar_filepath, mode="w", dereference=True)
+        # Audio is read straight from the source tars (instead of extracted copies) for entries with `source_tar`.
+        source_tars = SourceTarReader() if any("source_tar" in entry for entry in entries) else None
+        # Slices are collected and written after the loop, decoding each recording once.
+        slices = []
 
         count = dict()
         for entry in tqdm(entries, desc="Creating shard.."):
+            source_tar = entry.pop("source_tar", None)
             # We squash the filename since we do not preserve directory structure of audio files in the tarball.
-            if os.path.exists(entry["audio_filepath"]) or only_manifests:
+            if source_tar is not None or os.path.exists(entry["audio_filepath"]) or only_manifests:
                 audio_filepath = entry["audio_filepath"]
             else:
                 if not manifest_folder:
@@ -707,7 +867,7 @@ class ASRTarredDatasetBuilder:
 
                 to_write = base + "_" + entry_offset + "_" + entry_duration + ext
                 if not only_manifests:
-                    self._write_to_tar(tar, audio_filepath, to_write, duration=entry["duration"], offset=entry["offset"])
+                    slices.append((audio_filepath, to_write, entry["duration"], entry["offset"], source_tar))
                 count[squashed_filename] += 1
 
                 entry["source_audio_offset"] = entry["offset"]
@@ -715,7 +875,8 @@ class ASRTarredDatasetBuilder:
             else:
                 if squashed_filename not in count:
                     if not only_manifests:
-                        self._write_to_tar(tar, audio_filepath, squashed_filename)
+                        data = source_tars.read(*source_tar) if source_tar is not None else None
+                        self._write_to_tar(tar, audio_filepath, squashed_filename, data=data)
                     to_write = squashed_filename
                     count[squashed_filename] = 1
                 else:
@@ -733,8 +894,12 @@ class ASRTarredDatasetBuilder:
             }
             new_entries.append(new_entry)
 
+        if slices:
+            self._write_slices_to_tar(tar, slices, source_tars)
         if not only_manifests:
             tar.close()
+        if source_tars is not None:
+            source_tars.close()
         return new_entries
 
     @classmethod
@@ -787,6 +952,7 @@ def create_tar_datasets(
     write_metadata: bool = False,
     no_shard_manifests: bool = False,
     force_codec: str = None,
+    source_tar_mapping: str = None,
     workers: int = 1,
     slice_with_offset: bool = False,
     only_manifests: bool = False,
@@ -808,6 +974,7 @@ def create_tar_datasets(
             shard_manifests=shard_manifests,
             keep_files_together=keep_files_together,
             force_codec=force_codec,
+            source_tar_mapping=source_tar_mapping,
             slice_with_offset=slice_with_offset,
         )
         metadata.dataset_config = dataset_cfg
@@ -829,6 +996,7 @@ def create_tar_datasets(
             shard_manifests=shard_manifests,
             keep_files_together=keep_files_together,
             force_codec=force_codec,
+            source_tar_mapping=source_tar_mapping,
             slice_with_offset=slice_with_offset,
         )
         builder.configure(config)
@@ -865,6 +1033,7 @@ def create_tar_datasets(
         metadata.dataset_config.shuffle_seed = shuffle_seed
         metadata.dataset_config.sort_in_shards = sort_in_shards
         metadata.dataset_config.shard_manifests = shard_manifests
+        metadata.dataset_config.source_tar_mapping = source_tar_mapping
 
         builder.configure(metadata.dataset_config)
 
@@ -992,6 +1161,16 @@ if __name__ == "__main__":
         default=None,
         help=("If specified, transcode the audio to the given format. Supports libnsndfile formats (example values: 'opus', 'flac')."),
     )
+    parser.add_argument(
+        "--source_tar_mapping",
+        type=str,
+        default=None,
+        help=(
+            "Path to a json file mapping each manifest `audio_filepath` to [source tar path, data offset, size] "
+            "(made with `nemo_manifest.make_source_tar_mapping`). If set, the audio is copied from the source tars "
+            "into the shards instead of being read from extracted files."
+        ),
+    )
     parser.add_argument(
         "--only_manifests",
         action="store_true",
@@ -0,0 +1,186 @@
+import json_codec
+import load
+import locations
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+'''binary index of the whisper csv rows grouped by episode
+
+binary replacement of the csv episode dict (csv_episode_id_dict.json)
+the rows of the test, validation and train csv files are sorted on the
+episode key 'name-identifier' (keeping file order within an episode)
+and stored column by column in locations.csv_episode_index_directory:
+    header.json             columns, string columns and episode keys
+    episode_starts.npy      first row of each episode (plus the total)
+    <column>.npy            numerical columns
+    <column>.bytes          string columns as concatenated utf-8 bytes
+    <column>.offsets.npy    byte offset of each string (plus the total)
+    <column>.null.npy       missing values of a string column
+the arrays are memory mapped, an episode is read by slicing its row range
+'''
+
+def make_or_load(overwrite = False, directory = None):
+    '''load the csv episode index, make it from the csv files if it does
+    not exist or overwrite is True
+    '''
+    if directory is None:
+        directory = locations.csv_episode_index_directory
+    directory = Path(directory)
+    if not (directory / 'header.json').exists() or overwrite:
+        make_csv_episode_index(directory = directory)
+    return CsvEpisodeIndex(directory)
+
+def make_csv_episode_index(filenames = None, directory = None):
+    '''group the rows of the csv files on episode and save the index'''
+    if filenames is None:
+        filenames = [locations.csv_test, locations.csv_validation,
+            locations.csv_train]
+    if directory is None:
+        directory = locations.csv_episode_index_directory
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    print('Creating csv episode index from CSV segment files.')
+    df = pd.concat([load.load_csv_frame(f) for f in filenames],
+        ignore_index = True)
+    keys = (df['name'] + '-' + df['identifier']).to_numpy(dtype=str)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    df = df.iloc[order].reset_index(drop=True)
+    episode_keys, starts = np.unique(keys, return_index=True)
+    starts = np.append(starts, len(keys)).astype(np.int64)
+    np.save(directory / 'episode_starts.npy', starts)
+    string_columns = []
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_numeric_dtype(values):
+            np.save(directory / f'{column}.npy', values.to_numpy())
+        else:
+            string_columns.append(column)
+            _save_string_column(values, directory, column)
+    header = {'columns': list(df.columns), 'string_columns': string_columns,
+        'episode_keys': episode_keys.tolist()}
+    with open(directory / 'header.json', 'w', encoding='utf-8') as f:
+        json_codec.dump(header, f)
+    print(f'Saved {len(episode_keys)} episodes, {len(df)} rows to {directory}')
+
+def _save_string_column(values, directory, column):
+    null = values.isna().to_numpy()
+    encoded = [b'' if n else str(v).encode() for v, n in zip(values, null)]
+    lengths = np.fromiter((len(x) for x in encoded), dtype=np.int64,
+        count=len(encoded))
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    with open(directory / f'{column}.bytes', 'wb') as f:
+        f.write(b''.join(encoded))
+    np.save(directory / f'{column}.offsets.npy', offsets)
+    if null.any(): np.save(directory / f'{column}.null.npy', null)
+
+class CsvEpisodeIndex:
+    '''read access to the binary csv episode index
+    behaves like the csv episode dict: index[key] returns the csv rows of
+    an episode as a list of lists with name and identifier appended
+    only the rows of the requested episode are read from disk
+    '''
+    def __init__(self, directory = None):
+        if directory is None:
+            directory = locations.csv_episode_index_directory
+        self.directory = Path(directory)
+        with open(self.directory / 'header.json', encoding='utf-8') as f:
+            header = json_codec.load(f)
+        self.columns = header['columns']
+        self.string_columns = header['string_columns']
+        self.episode_keys = header['episode_keys']
+        self.key_to_index = {k: i for i, k in enumerate(self.episode_keys)}
+        self.starts = self._load('episode_starts.npy')
+        self.data = {}
+        for column in self.columns:
+            if column in self.string_columns:
+                self.data[column] = self._load_string_column(column)
+            else: self.data[column] = self._load(f'{column}.npy')
+
+    def __repr__(self):
+        m = f"<CsvEpisodeIndex {len(self)} episodes, "
+        m += f"{self.starts[-1]} rows>"
+        return m
+
+    def __len__(self):
+        return len(self.episode_keys)
+
+    def __contains__(self, key):
+        return key in self.key_to_index
+
+    def __getitem__(self, key):
+        if key not in self.key_to_index:
+            raise KeyError(key)
+        start, end = self.row_range(key)
+        columns = [self._column_slice(c, start, end) for c in self.columns]
+        return [list(row) for row in zip(*columns)]
+
+    def __iter__(self):
+        return iter(self.episode_keys)
+
+    def keys(self):
+        return self.episode_keys
+
+    def items(self):
+        for key in self.episode_keys:
+            yield key, self[key]
+
+    def row_range(self, key):
+        '''return the (start, end) rows of an episode, end is exclusive'''
+        i = self.key_to_index[key]
+        return int(self.starts[i]), int(self.starts[i + 1])
+
+    def column(self, column, key):
+        '''return the values of a single column of an episode'''
+        return self._column_slice(column, *self.row_range(key))
+
+    def values(self, column, rows = None):
+        '''return the values of a column for the given rows (default all)
+        numerical columns are returned as a numpy array, string columns as
+        a list
+        '''
+        if rows is None: rows = np.arange(self.starts[-1])
+        if column not in self.string_columns:
+            return np.asarray(self.data[column][rows])
+        data, offsets, null = self.data[column]
+        values = []
+        for i in rows.tolist():
+            if null is not None and null[i]: values.append(float('nan'))
+            else: values.append(data[offsets[i]:offsets[i + 1]].tobytes().decode())
+        return values
+
+    def row_episode_keys(self):
+        '''return the episode key of every row'''
+        counts = np.diff(self.starts)
+        return np.repeat(np.array(self.episode_keys, dtype=object), counts)
+
+    def row_segment_index(self):
+        '''return the position of every row within its episode'''
+        counts = np.diff(self.starts)
+        return np.arange(self.starts[-1]) - np.repeat(self.starts[:-1], counts)
+
+    def _load(self, filename):
+        return np.load(self.directory / filename, mmap_mode='r')
+
+    def _load_string_column(self, column):
+        filename = self.directory / f'{column}.bytes'
+        # np.memmap can not map an empty file
+        if filename.stat().st_size == 0: data = np.zeros(0, dtype=np.uint8)
+        else: data = np.memmap(filename, dtype=np.uint8, mode='r')
+        offsets = self._load(f'{column}.offsets.npy')
+        null_filename = self.directory / f'{column}.null.npy'
+        null = np.load(null_filename) if null_filename.exists() else None
+        return data, offsets, null
+
+    def _column_slice(self, column, start, end):
+        if column not in self.string_columns:
+            return self.data[column][start:end].tolist()
+        data, offsets, null = self.data[column]
+        values = []
+        for i in range(start, end):
+            if null is not None and null[i]: values.append(float('nan'))
+            else:
+                b = data[offsets[i]:offsets[i + 1]].tobytes()
+                values.append(b.decode())
+        return values
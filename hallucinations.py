@@ -1,7 +1,10 @@
 import copy
-import json
+import json_codec
 import load
 import locations
+from multiprocessing import Pool
+import numpy as np
+import os
 from progressbar import progressbar
 import re
 
@@ -69,6 +72,71 @@ def ngram_repeat_coverage(text,n=5):
         "repeats": repeats,"total_repeats": sum(repeats.values()) }
     return output
 
+def ngram_repeat_coverage_batch(texts, n=5):
+    '''Compute coverage by repeated n-grams for many texts at once.
+    texts - list of input text strings
+    n - n-gram size (default 5)
+    returns a list with for each text the coverage_ratio, covered_tokens,
+    total_tokens and total_repeats as ngram_repeat_coverage (without the
+    repeats dict) or None if the text has no tokens
+
+    tokens are mapped to integer ids, n-grams are compared with a 64 bit
+    polynomial hash and coverage is marked with a difference array
+    '''
+    vocab = {}
+    ids, lengths = [], []
+    for text in texts:
+        words = text_to_word(text)
+        ids.extend(vocab.setdefault(w, len(vocab) + 1) for w in words)
+        lengths.append(len(words))
+    ids = np.array(ids, dtype=np.uint64)
+    lengths = np.array(lengths, dtype=np.int64)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    n_tokens = len(ids)
+    text_index = np.repeat(np.arange(len(texts)), lengths)
+    covered = np.zeros(n_tokens, dtype=bool)
+    repeat_counts = np.zeros(len(texts), dtype=np.int64)
+    n_windows = n_tokens - n + 1
+    if n_windows > 0:
+        # rolling hash of every window, keep windows within a single text
+        hashes = np.zeros(n_windows, dtype=np.uint64)
+        base = np.uint64(0x9E3779B97F4A7C15)
+        for k in range(n):
+            hashes = hashes * base + ids[k:k + n_windows]
+        window_text = text_index[:n_windows]
+        valid = window_text == text_index[n - 1:]
+        window_starts = np.flatnonzero(valid)
+        hashes, window_text = hashes[valid], window_text[valid]
+        # group equal n-grams within a text, groups of size > 1 are repeats
+        order = np.lexsort((hashes, window_text))
+        h, t = hashes[order], window_text[order]
+        boundary = np.ones(len(order), dtype=bool)
+        boundary[1:] = (h[1:] != h[:-1]) | (t[1:] != t[:-1])
+        group = np.cumsum(boundary) - 1
+        group_size = np.bincount(group)
+        repeated = np.zeros(len(order), dtype=bool)
+        repeated[order] = group_size[group] > 1
+        repeated_starts = window_starts[repeated]
+        repeat_counts = np.bincount(window_text[repeated], 
+            minlength=len(texts))
+        delta = np.zeros(n_tokens + 1, dtype=np.int64)
+        np.add.at(delta, repeated_starts, 1)
+        np.add.at(delta, repeated_starts + n, -1)
+        covered = np.cumsum(delta[:-1]) > 0
+    covered_cumsum = np.concatenate([[0], np.cumsum(covered)])
+    covered_tokens = covered_cumsum[ends] - covered_cumsum[starts]
+    output = []
+    for total, covered_n, repeats in zip(lengths.tolist(), 
+        covered_tokens.tolist(), repeat_counts.tolist()):
+        if total == 0: 
+            output.append(None)
+            continue
+        output.append({"coverage_ratio": covered_n / total,
+            "covered_tokens": covered_n, "total_tokens": total,
+            "total_repeats": repeats})
+    return output
+
 def csv_segment_to_text(segment):
     return segment[3].strip()
 
@@ -108,22 +176,22 @@ def handle_program_name(name, overwrite = False, other_programs = None):
     if f.exists() and not overwrite:
         print(f"{f} exists, skipping.")
         return
-    program = load.load_csv_program(name, other_programs=other_programs)
+    # each program is handled once, caching would only hold memory
+    program = load.load_csv_program(name, other_programs=other_programs,
+        use_cache=False)
     nt = csv_program_to_segment_name_text(program)
+    coverages = ngram_repeat_coverage_batch([text for _, text in nt])
     output = {}
-    for segment_name, text in nt:
+    for (segment_name, text), rp in zip(nt, coverages):
         name, identifier = segment_name.split('-')
         if identifier not in output: output[identifier] = []
         segment_d = {'name': name, 'identifier': identifier, 'text': text}
-        rp = ngram_repeat_coverage(text)
         if rp == None: 
             output[identifier].append(segment_d)
             continue
-        del rp['repeats']
         segment_d.update(rp)
         output[identifier].append(segment_d)
-    with open(f, 'w') as fout:
-        json.dump(output, fout)
+    save_json_atomic(output, f)
     return output
 
 def handle_all_programs(overwrite = False, other_programs = None):
@@ -170,30 +238,133 @@ def handle_manifest_programs(manifest_program_dict = None,
     other_programs = None, overwrite = False):
     if manifest_program_dict is None:
         manifest_program_dict = load.load_manifest_program_dict(other_programs)
-    directory = locations.program_directory
     for name, program in progressbar(manifest_program_dict.items()):
-        filename = locations.program_directory / f'{name}.json'
-        if filename.exists() and not overwrite: 
-            print(f"{filename} exists, skipping.")
-            continue
-        for identifier, episode in program['episodes'].items():
-            segments = []
-            for s in episode['segments']:
-                s = clean_manifest_segment(s)
-                o = ngram_repeat_coverage(s['text'])
-                if o is not None:
-                    s['ngram_ratio'] = o['coverage_ratio']
-                else:
-                    s['ngram_ratio'] = None
-                    print(f'no text in segment {s}')
-                segments.append(s)
-            episode['segments'] = segments
-        with open(filename, 'w') as fout:
-            json.dump(program, fout)
+        handle_manifest_program(name, program, overwrite)
     return manifest_program_dict
 
-                
-                
+def handle_manifest_program(name, program, overwrite = False):
+    '''add the ngram_ratio to the segments of a manifest program and save it
+    to locations.program_directory
+    '''
+    filename = locations.program_directory / f'{name}.json'
+    if filename.exists() and not overwrite: 
+        print(f"{filename} exists, skipping.")
+        return
+    for identifier, episode in program['episodes'].items():
+        segments = [clean_manifest_segment(s) for s in episode['segments']]
+        coverages = ngram_repeat_coverage_batch(
+            [s['text'] for s in segments])
+        for s, o in zip(segments, coverages):
+            if o is not None:
+                s['ngram_ratio'] = o['coverage_ratio']
+            else:
+                s['ngram_ratio'] = None
+                print(f'no text in segment {s}')
+        episode['segments'] = segments
+    save_json_atomic(program, filename)
+    return program
+
+def save_json_atomic(d, filename):
+    '''write json to a temporary file and rename it to filename
+    so filename is either absent or complete'''
+    tmp = filename.parent / f'{filename.name}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as fout:
+        json_codec.dump(d, fout)
+    os.replace(tmp, filename)
+
+# parallel resumable scoring
+
+def load_journal(journal_filename):
+    '''return the set of program names recorded as done in the journal'''
+    if not journal_filename.exists(): return set()
+    with open(journal_filename, encoding='utf-8') as fin:
+        return set(x for x in fin.read().split('\n') if x)
+
+def _append_journal(journal_filename, name):
+    with open(journal_filename, 'a', encoding='utf-8') as fout:
+        fout.write(name + '\n')
+        fout.flush()
+        os.fsync(fout.fileno())
+
+def program_file_sizes(names, directory):
+    '''file size of each program json, programs with a single episode are
+    in other_programs.json and get size 0'''
+    sizes = {}
+    for name in names:
+        f = directory / f'{name}.json'
+        sizes[name] = f.stat().st_size if f.exists() else 0
+    return sizes
+
+_worker_other_programs = None
+
+def _init_csv_worker():
+    global _worker_other_programs
+    _worker_other_programs = load._load_other_csv_programs()
+
+def _init_manifest_worker():
+    global _worker_other_programs
+    _worker_other_programs = load._load_other_manifest_programs()
+
+def _csv_program_worker(name):
+    handle_program_name(name, overwrite = True, 
+        other_programs = _worker_other_programs)
+    return name
+
+def _manifest_program_worker(name):
+    program = load.load_manifest_program(name, _worker_other_programs)
+    handle_manifest_program(name, program, overwrite = True)
+    return name
+
+def _run_programs_mp(names, worker, initializer, sizes, journal_filename,
+    num_workers, overwrite, journal_key = None):
+    '''run worker for each program name not yet in the journal
+    programs are handed out largest first, each finished program is 
+    appended to the journal so an interrupted run restarts where it stopped
+    journal_key     stored next to the journal, a journal made with a
+                    different key is started over (e.g. the pipeline stage
+                    fingerprint, so only a run on the same inputs resumes)
+    '''
+    key_filename = journal_filename.parent / f'{journal_filename.name}.key'
+    if journal_key is not None:
+        old_key = key_filename.read_text() if key_filename.exists() else None
+        if old_key != journal_key: overwrite = True
+    if overwrite and journal_filename.exists():
+        journal_filename.unlink()
+    if journal_key is not None: key_filename.write_text(journal_key)
+    done = load_journal(journal_filename)
+    todo = [name for name in names if name not in done]
+    todo.sort(key = lambda name: sizes[name], reverse = True)
+    print(f'{len(done)} programs done, {len(todo)} programs to handle')
+    with Pool(processes=num_workers, initializer=initializer) as pool:
+        for name in progressbar(pool.imap_unordered(worker, todo),
+            max_value = len(todo)):
+            _append_journal(journal_filename, name)
+
+def handle_all_programs_mp(overwrite = False, num_workers = 6):
+    '''Process all programs in parallel to compute hallucination metrics.
+    completed programs are recorded in a journal in 
+    locations.hallucinations_directory, overwrite starts a new journal
+    '''
+    names = load.load_program_names()
+    sizes = program_file_sizes(names, locations.csv_program_directory)
+    journal_filename = locations.hallucinations_directory / 'journal.txt'
+    _run_programs_mp(names, _csv_program_worker, _init_csv_worker, sizes,
+        journal_filename, num_workers, overwrite)
+
+def handle_manifest_programs_mp(overwrite = False, num_workers = 6,
+    journal_key = None):
+    '''Process all manifest programs in parallel, see handle_manifest_program
+    completed programs are recorded in a journal in 
+    locations.program_directory, overwrite starts a new journal
+    journal_key     see _run_programs_mp
+    '''
+    names = load.load_program_names()
+    sizes = program_file_sizes(names, locations.manifest_program_directory)
+    locations.program_directory.mkdir(exist_ok=True)
+    journal_filename = locations.program_directory / 'journal.txt'
+    _run_programs_mp(names, _manifest_program_worker, _init_manifest_worker,
+        sizes, journal_filename, num_workers, overwrite, journal_key)
+
 def clean_manifest_segment(segment):
     s = copy.copy(segment)
     s['text'] = s['whisper_text']
@@ -205,7 +376,6 @@ def clean_manifest_segment(segment):
     del s['end_time']
     del s['whisper_text']
     del s['manifest_filename']
-    del s['levenshtein_ratio']
     return s
     
     
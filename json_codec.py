@@ -0,0 +1,172 @@
+import json
+import math
+import pickle
+import re
+from typing import Optional, TypedDict
+
+'''json encoding and decoding for all load and save paths
+
+uses orjson or msgspec when installed and the standard library json module
+otherwise. the functions follow the json module (loads, dumps, load, dump)
+and add batched jsonl writing and typed decoding of segment records.
+
+notes on the fast backends:
+- documents the fast backend can not handle (NaN values written by the
+  json module, integers larger than 64 bit) fall back to the json module
+- dumps writes compact utf-8 json (no spaces, ensure_ascii is ignored),
+  open files written with it with encoding='utf-8'
+- the fast backends write NaN and inf as null, documents with NaN or inf
+  are written with the json module instead (NaN, Infinity), so values match
+  the json module
+- a document whose fast output contains null (None values) is checked for
+  non-finite floats on its pickle, this adds about 2/3 of the fast encode
+  time (the json module takes about 4 times the fast encode time)
+'''
+
+try:
+    import orjson
+    backend = 'orjson'
+except ImportError:
+    orjson = None
+    try:
+        import msgspec
+        backend = 'msgspec'
+    except ImportError:
+        msgspec = None
+        backend = 'json'
+
+class SegmentRecord(TypedDict, total = False):
+    '''schema of a segment record in the segments jsonl files'''
+    audio_filepath: str
+    text: str
+    duration: float
+    name: str
+    identifier: str
+    segment_id: str
+    tar_filename: str
+    manifest_filename: str
+    split: str
+    org_split: str
+    org_start: Optional[float]
+    org_end: Optional[float]
+    whisper_text: str
+    start_time: Optional[float]
+    end_time: Optional[float]
+    levenshtein_ratio: Optional[float]
+    ngram_ratio: Optional[float]
+
+def _contains_nonfinite(obj):
+    '''True if obj contains a NaN or infinite float (python walk)'''
+    if isinstance(obj, float): return not math.isfinite(obj)
+    stack = [obj]
+    while stack:
+        values = stack.pop()
+        if isinstance(values, dict): values = values.values()
+        elif not isinstance(values, (list, tuple)): continue
+        for v in values:
+            if isinstance(v, float):
+                if not math.isfinite(v): return True
+            elif isinstance(v, (dict, list, tuple)): stack.append(v)
+    return False
+
+# pickle writes a float as G + 8 byte big endian double, a non-finite double
+# has all exponent bits set. a string can match by chance, that only causes
+# a needless fallback to the json module
+_nonfinite_pickle = re.compile(rb'G[\x7f\xff][\xf0-\xff]')
+
+def _may_contain_nonfinite(obj):
+    '''True if obj can contain a NaN or infinite float
+    checks the pickle of obj (C speed) instead of walking obj in python,
+    numpy scalars are pickled differently and are checked with the walk
+    '''
+    try: p = pickle.dumps(obj, protocol = pickle.HIGHEST_PROTOCOL)
+    except Exception: return _contains_nonfinite(obj)
+    if b'numpy' in p: return _contains_nonfinite(obj)
+    return _nonfinite_pickle.search(p) is not None
+
+if backend == 'orjson':
+    _options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def _loads(s):
+        return orjson.loads(s)
+
+    def _dumps(obj, indent):
+        options = _options | orjson.OPT_INDENT_2 if indent else _options
+        return orjson.dumps(obj, option = options).decode()
+
+elif backend == 'msgspec':
+    _decoder = msgspec.json.Decoder()
+    _encoder = msgspec.json.Encoder()
+
+    def _loads(s):
+        return _decoder.decode(s)
+
+    def _dumps(obj, indent):
+        b = _encoder.encode(obj)
+        if indent: b = msgspec.json.format(b, indent = indent)
+        return b.decode()
+
+def loads(s):
+    '''decode a json document (str or bytes)'''
+    if backend == 'json': return json.loads(s)
+    try: return _loads(s)
+    except (ValueError, TypeError): return json.loads(s)
+
+def dumps(obj, indent = None, ensure_ascii = True):
+    '''encode obj as a json str'''
+    if backend == 'json':
+        return json.dumps(obj, indent = indent, ensure_ascii = ensure_ascii)
+    try: s = _dumps(obj, indent)
+    except (ValueError, TypeError, OverflowError):
+        return json.dumps(obj, indent = indent, ensure_ascii = ensure_ascii)
+    # NaN and inf are written as null, only documents with null can hold them
+    if 'null' in s and _may_contain_nonfinite(obj):
+        return json.dumps(obj, indent = indent, ensure_ascii = ensure_ascii)
+    return s
+
+def load(f):
+    '''decode the json document in file object f'''
+    return loads(f.read())
+
+def dump(obj, f, indent = None, ensure_ascii = True):
+    '''write obj as json to file object f'''
+    f.write(dumps(obj, indent = indent, ensure_ascii = ensure_ascii))
+
+def dumps_line(obj, ensure_ascii = True):
+    '''encode obj as a single jsonl line (with newline)'''
+    return dumps(obj, ensure_ascii = ensure_ascii) + '\n'
+
+def write_lines(records, f, batch_size = 1024, ensure_ascii = True):
+    '''write records as jsonl to file object f, batch_size lines per write
+    returns the number of written records'''
+    n, batch = 0, []
+    for record in records:
+        batch.append(dumps(record, ensure_ascii = ensure_ascii))
+        if len(batch) >= batch_size:
+            f.write('\n'.join(batch) + '\n')
+            n += len(batch)
+            batch = []
+    if batch:
+        f.write('\n'.join(batch) + '\n')
+        n += len(batch)
+    return n
+
+if backend == 'msgspec':
+    _segment_decoder = msgspec.json.Decoder(SegmentRecord)
+elif backend == 'orjson':
+    try:
+        import msgspec
+        _segment_decoder = msgspec.json.Decoder(SegmentRecord)
+    except ImportError: _segment_decoder = None
+else: _segment_decoder = None
+
+def decode_segment(line):
+    '''decode a segment record and check it against SegmentRecord
+    requires msgspec for the schema check, without it this is loads
+    note: with msgspec keys that are not in SegmentRecord are dropped
+    '''
+    if _segment_decoder is None: return loads(line)
+    try: return _segment_decoder.decode(line)
+    except msgspec.DecodeError:
+        # NaN written by the json module, checked without schema
+        return json.loads(line)
@@ -1,5 +1,7 @@
-import json
+from collections import OrderedDict
+import json_codec
 import locations
+from multiprocessing import Pool
 import pandas as pd
 from pathlib import Path
 from progressbar import progressbar
@@ -10,32 +12,80 @@ def load_manifest(filename):
     '''manifest json file contains a json object per line
     the manifest correspond to a single tar file with audio files
     '''
-    with open(filename) as f:
-        t = f.read().split('\n')
-    output = []
+    filename = Path(filename)
     error = []
-    for line in t:
-        try: d = json.loads(line)
-        except: error.append(line); continue
-        info = audio_filepath_to_info(d['audio_filepath'])
-        d.update(info)
-        output.append(d)
+    output = list(iter_manifest(filename, error, add_manifest_info = False))
+    d = manifest_filename_to_info(filename)
+    d.update({'data': output, 'error': error})
+    return d
+
+def manifest_filename_to_info(filename):
+    '''return the manifest filename, split and tar filename of a manifest'''
+    filename = Path(filename)
     split = filename.parent.name
     tar_filename = filename.stem.replace('.manifest', '.tar')
-    return {'manifest_filename': filename.name, 'split': split, 'data': output, 
-        'error': error, 'tar_filename': tar_filename}
-
-def load_all_manifests(filenames = None):
+    return {'manifest_filename': filename.name, 'split': split,
+        'tar_filename': tar_filename}
+
+def iter_manifest(filename, error = None, add_manifest_info = True):
+    '''yield the entries of a manifest json file one line at a time
+    each entry is updated with the audio_filepath_to_info fields
+    if add_manifest_info the manifest_filename, split and tar_filename
+    are added to each entry
+    lines that can not be parsed are appended to error (if provided)
+    '''
+    filename = Path(filename)
+    if add_manifest_info: info = manifest_filename_to_info(filename)
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line: continue
+            try: d = json_codec.loads(line)
+            except:
+                if error is not None: error.append(line)
+                continue
+            d.update(audio_filepath_to_info(d['audio_filepath']))
+            if add_manifest_info: d.update(info)
+            yield d
+
+def load_all_manifests(filenames = None, num_workers = 1, chunksize = 16):
     '''load all manifests from a list of filenames
     default is all manifests in locations.manifest_filenames
+    if num_workers > 1 the manifests are parsed in a process pool
     '''
     if filenames is None:
         filenames = locations.manifest_filenames
+    if num_workers > 1:
+        return load_all_manifests_mp(filenames, num_workers, chunksize)
     manifests = []
     for f in progressbar(filenames):
         manifests.append(load_manifest(f))
     return manifests
 
+def load_all_manifests_mp(filenames = None, num_workers = 6, chunksize = 16):
+    '''load all manifests with a pool of num_workers processes
+    filenames are handed to the workers in chunks of chunksize files
+    the manifests are returned in the order of filenames, unparsable lines
+    are reported per manifest in the error list (see load_manifest)
+    '''
+    if filenames is None:
+        filenames = locations.manifest_filenames
+    filenames = list(filenames)
+    with Pool(processes=num_workers) as pool:
+        iterator = pool.imap(load_manifest, filenames, chunksize = chunksize)
+        manifests = list(progressbar(iterator, max_value = len(filenames)))
+    return manifests
+
+def iter_all_manifests(filenames = None, error = None):
+    '''yield the entries of all manifests from a list of filenames
+    streaming variant of load_all_manifests, only one line is held in memory
+    default is all manifests in locations.manifest_filenames
+    '''
+    if filenames is None:
+        filenames = locations.manifest_filenames
+    for f in progressbar(filenames):
+        yield from iter_manifest(f, error)
+
 def load_test_manifests():
     '''load all manifest files from the test set'''
     return load_all_manifests(locations.test_filenames)
@@ -100,6 +150,20 @@ def load_csv(filename):
         line.extend([name,identifier])
     return header, data
 
+def load_csv_frame(filename):
+    '''vectorized variant of load_csv, returns a dataframe with the csv
+    columns plus name and identifier columns
+    '''
+    df = pd.read_csv(filename)
+    stem = df.iloc[:, 0].str.split('/').str[-1].str.split('.').str[0]
+    parts = stem.str.split('-')
+    ok = parts.str.len() == 2
+    if not ok.all():
+        print(f'{(~ok).sum()} filenames do not conform to expected format')
+    df['name'] = parts.str[0].where(ok, NO_NAME)
+    df['identifier'] = parts.str[-1]
+    return df
+
 def _make_csv_episode_id_dict(filename, episode_id_dict = {}):
     '''make episode id dict from a single csv file (test, validation, train)
     '''
@@ -122,8 +186,8 @@ def _make_or_load_csv_program_episode_dict(overwrite=False):
     if locations.csv_episode_dict_filename.exists() and not overwrite:
         p = locations.csv_episode_dict_filename
         print(f'Loading episode dict from {p}')
-        with open(locations.csv_episode_dict_filename) as f:
-            d = episode_id_dict = json.load(f)
+        with open(locations.csv_episode_dict_filename, encoding='utf-8') as f:
+            d = episode_id_dict = json_codec.load(f)
         return d
     print('Creating episode dict from CSV segment files.')
     episode_id_dict = {}
@@ -132,42 +196,98 @@ def _make_or_load_csv_program_episode_dict(overwrite=False):
     for filename in filenames:
         _make_csv_episode_id_dict(filename, episode_id_dict)
     print(f'Saving episode dict to {locations.csv_episode_dict_filename}')
-    with open(locations.csv_episode_dict_filename, 'w') as f:
-        json.dump(episode_id_dict, f)
+    with open(locations.csv_episode_dict_filename, 'w', encoding='utf-8') as f:
+        json_codec.dump(episode_id_dict, f)
     return episode_id_dict
             
-def load_csv_program(name, other_programs = None):
+class ProgramCache:
+    '''bounded least recently used cache of loaded program dicts
+    the memory of a program is estimated as parsed_size_factor times the
+    size of its json file (measured ~4.2 for the program files), programs
+    are evicted when the estimated total exceeds max_bytes
+    '''
+    def __init__(self, max_bytes = 2 * 1024**3, parsed_size_factor = 4.2):
+        self.max_bytes = max_bytes
+        self.parsed_size_factor = parsed_size_factor
+        self.programs = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        m = f"<ProgramCache {len(self.programs)} programs "
+        m += f"{self.total_bytes / 1024**2:.1f} MB, hits {self.hits} "
+        m += f"misses {self.misses}>"
+        return m
+
+    def get(self, name):
+        '''return the cached program or None'''
+        if name not in self.programs:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.programs.move_to_end(name)
+        return self.programs[name][0]
+
+    def put(self, name, program, file_size):
+        size = int(file_size * self.parsed_size_factor)
+        if size > self.max_bytes: return
+        if name in self.programs:
+            self.total_bytes -= self.programs.pop(name)[1]
+        self.programs[name] = (program, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.programs.popitem(last = False)
+            self.total_bytes -= evicted_size
+
+    def clear(self):
+        self.programs.clear()
+        self.total_bytes = 0
+
+# shared by load_csv_program callers that load a program more than once
+# (manifest.Episode), callers that load each program once pass use_cache=False
+csv_program_cache = ProgramCache()
+
+def load_csv_program(name, other_programs = None, use_cache = True):
     '''load a program json file by name from locations.csv_program_directory
     the programs are based on the csv files
     a program contains episodes, which contain segments
 
     all programs with a single episode are stored in other_programs.json
+    loaded programs are kept in csv_program_cache (if use_cache), the
+    returned program should not be modified
     '''
     filename = locations.csv_program_directory / f"{name}.json"
     if other_programs is not None and name in other_programs:
         return other_programs[name]
+    if use_cache:
+        d = csv_program_cache.get(name)
+        if d is not None: return d
     if not filename.exists():
         m = f"Program file {filename} does not exist."
-        with open(locations.csv_program_directory / "other_programs.json") as f:
-            d = json.load(f)
+        with open(locations.csv_program_directory / "other_programs.json",
+            encoding='utf-8') as f:
+            d = json_codec.load(f)
         if name in d:
             m += f" Found in other_programs.json."
             print(m)
             return d[name]
-    with open(filename) as f:
-        d = json.load(f)
+    with open(filename, encoding='utf-8') as f:
+        d = json_codec.load(f)
+    if use_cache: csv_program_cache.put(name, d, filename.stat().st_size)
     return d
 
 def _load_other_csv_programs():
     '''all programs with a single episode are stored in other_programs.json
     '''
-    with open(locations.csv_program_directory / "other_programs.json") as f:
-        d = json.load(f)
+    with open(locations.csv_program_directory / "other_programs.json",
+        encoding='utf-8') as f:
+        d = json_codec.load(f)
     return d
     
 def load_program_names():
     '''return a list of all program names from program_names.txt'''
-    with open('../program_names.txt') as f:
+    with open(locations.program_names_filename) as f:
         t = f.read().split('\n')
     t = [x for x in t if x]
     return t
@@ -180,8 +300,8 @@ def load_program_episode_count():
     return t
 
 def load_program_info():
-    with open(locations.program_info_filename) as f:
-        d = json.load(f)
+    with open(locations.program_info_filename, encoding='utf-8') as f:
+        d = json_codec.load(f)
     return d
 
 
@@ -204,15 +324,16 @@ def load_hallucination_program(name):
     if not f.exists():
         m = f"Hallucination file {f} does not exist."
         raise ValueError(m)
-    with open(f) as fin:
-        d = json.load(fin)
+    with open(f, encoding='utf-8') as fin:
+        d = json_codec.load(fin)
     return d
 
 def _load_other_manifest_programs():
     '''all programs with a single episode are stored in other_programs.json
     '''
-    with open(locations.manifest_program_directory / "other_programs.json") as f:
-        d = json.load(f)
+    with open(locations.manifest_program_directory / "other_programs.json",
+        encoding='utf-8') as f:
+        d = json_codec.load(f)
     return d
 
 def load_manifest_program(name, other_programs = None):
@@ -223,8 +344,8 @@ def load_manifest_program(name, other_programs = None):
     if not f.exists():
         m = f"Manifest program file {f} does not exist."
         raise ValueError(m)
-    with open(f) as fin:
-        d = json.load(fin)
+    with open(f, encoding='utf-8') as fin:
+        d = json_codec.load(fin)
     return d
 
 def load_manifest_program_dict(other_programs = None):
@@ -241,8 +362,8 @@ def load_program(name):
     if not f.exists():
         m = f"program file {f} does not exist."
         raise ValueError(m)
-    with open(f) as fin:
-        d = json.load(fin)
+    with open(f, encoding='utf-8') as fin:
+        d = json_codec.load(fin)
     return d
 
 def load_program_dict():
@@ -252,18 +373,33 @@ def load_program_dict():
         d[name] = load_program(name)
     return d
 
-def load_segments(filename):
+def load_segments(filename, typed = False):
     f = locations.BASE_DIR / filename
     if not f.exists():
         m = f"segments file {f} does not exist."
         raise ValueError(m)
+    decode = json_codec.decode_segment if typed else json_codec.loads
     segments = []
-    with open(f) as fin:
+    with open(f, encoding='utf-8') as fin:
         for line in progressbar(fin.read().split('\n')):
             if not line: continue
-            segments.append(json.loads(line))
+            segments.append(decode(line))
     return segments
 
+def iter_segments(filename, typed = False):
+    '''yield the segments of a segments jsonl file one line at a time
+    typed   check the segments against json_codec.SegmentRecord
+    '''
+    f = locations.BASE_DIR / filename
+    if not f.exists():
+        m = f"segments file {f} does not exist."
+        raise ValueError(m)
+    decode = json_codec.decode_segment if typed else json_codec.loads
+    with open(f, encoding='utf-8') as fin:
+        for line in fin:
+            if not line.strip(): continue
+            yield decode(line)
+
 def load_clean_segments():
     return load_segments('segments.jsonl')
 
@@ -283,12 +419,12 @@ def load_subset_5000_clean_segments():
     return load_segments('clean_5000h_segments.jsonl')
 
 def load_nemo_manifest(filename = '../nemo_manifest_bg_5000h.jsonl'):
-    with open(filename) as f:
+    with open(filename, encoding='utf-8') as f:
         t = f.read().split('\n')
     output = []
     error = []
     for line in progressbar(t):
-        try: d = json.loads(line)
+        try: d = json_codec.loads(line)
         except: error.append(line); continue
         output.append(d)
     print('error',error)
@@ -20,18 +20,28 @@ csv_validation = csv_dir / "validation_segments.csv"
 csv_train = csv_dir / "train_segments.csv"
 
 csv_episode_dict_filename = BASE_DIR / "csv_episode_id_dict.json"
+csv_episode_index_directory = BASE_DIR / "csv_episode_index"
 
 csv_program_directory = BASE_DIR / "csv_programs"
 program_info_filename = BASE_DIR / "program_info.json"
+program_names_filename = BASE_DIR / "program_names.txt"
 
 manifest_program_directory = BASE_DIR / "manifest_programs"
+similarity_cache_filename = BASE_DIR / "levenshtein_ratio_cache.json"
 
 hallucinations_directory = BASE_DIR / "hallucinations"
 
 #directory for final metadata
 program_directory = BASE_DIR / "programs"
+catalog_filename = BASE_DIR / "catalog.sqlite"
 
 
 tar_base_path = Path('/projects/0/prjs1489/data/nibg/nemo/ogg/')
 audio_base_path = Path('/scratch-shared/mbentum1/audio/')
 
+#tarred NeMo dataset made with convert_to_tarred_audio_dataset
+tarred_dataset_directory = BASE_DIR / "tarred"
+
+#sidecar byte offset indices of the tars in tar_base_path
+tar_index_directory = BASE_DIR / "tar_indices"
+
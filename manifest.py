@@ -1,17 +1,25 @@
-import json
-import Levenshtein
+from array import array
+import json_codec
 import load
 import locations
+import numpy as np
+import os
 from progressbar import progressbar
 import segment_matcher
+import similarity
 import textwrap
 
 '''preprocessing module'''
 
-def load_all_manifests(filenames = None):
+def load_all_manifests(filenames = None, num_workers = 1):
     '''Load all manifest files corresponding to tarred sets of audio files.
     '''
-    return load.load_all_manifests(filenames)
+    return load.load_all_manifests(filenames, num_workers = num_workers)
+
+def iter_all_manifests(filenames = None):
+    '''Yield the entries of all manifest files one line at a time.
+    '''
+    return load.iter_all_manifests(filenames)
 
 class Episode:
     def __init__(self, identifier, segments, parent = None, do_match = True):
@@ -51,14 +59,19 @@ class Episode:
             self.match_ok = False
         else: 
             self.match_ok = True
-            for s in self.segments:
-                s.levenshtein_ratio = Levenshtein.ratio(s.text.lower(), 
-                    s.whisper_text.lower())
+            pairs = [(s.text.lower(), s.whisper_text.lower()) 
+                for s in self.segments]
+            ratios = similarity.levenshtein_ratios(pairs)
+            for s, ratio in zip(self.segments, ratios):
+                s.levenshtein_ratio = ratio
                 
 
 class Segments:
     def __init__(self, manifest_filenames = None, other_programs = None, 
-        do_match = True, make_episodes = False):
+        do_match = True, make_episodes = False, compact = True):
+        '''compact     store the segments in a columnar SegmentTable
+                    segments are then Segment views created on demand
+        '''
         if manifest_filenames is None:
             manifest_filenames = locations.manifest_filenames
         if other_programs is None:
@@ -66,6 +79,7 @@ class Segments:
         else: self.other_programs = other_programs
         if not make_episodes: do_match = False
         self.do_match = do_match
+        self.compact = compact
         print('make segments')
         self._handle_make_segments(manifest_filenames)
         if make_episodes:
@@ -77,17 +91,13 @@ class Segments:
         return f"<Segments {len(self.segments)} segments>"
 
     def _handle_make_segments(self, manifest_filenames):
-        manifests = load_all_manifests(manifest_filenames)
+        if self.compact:
+            self.table = SegmentTable(iter_all_manifests(manifest_filenames))
+            self.segments = self.table
+            return
         self.segments = []
-        for item in progressbar(manifests):
-            tar_filename = item['tar_filename']
-            split = item['split']
-            for line in item['data']:
-                line['tar_filename'] = item['tar_filename']
-                line['manifest_filename'] = item['manifest_filename']
-                line['split'] = item['split']
-                segment = Segment(**line)
-                self.segments.append(segment)
+        for line in iter_all_manifests(manifest_filenames):
+            self.segments.append(Segment(**line))
         self.segments.sort(key = lambda x: (x.name, x.identifier, int(x.segment_id)))
 
     def _handle_make_episodes(self):
@@ -117,6 +127,30 @@ class Segments:
         for episode in progressbar(self.episodes):
             episode._handle_match()
         self.match_handled = True
+        print(load.csv_program_cache)
+        similarity.get_cache().save()
+
+    def handle_similarity(self, num_workers = 6, cutoff = None):
+        '''compute the levenshtein ratio of all matched segments in one batch
+        with a pool of num_workers processes
+        cutoff      ratios below cutoff are set to 0, enough for the
+                    threshold check in check_episodes (e.g. cutoff = .7)
+        '''
+        matched = [s for s in self.segments if hasattr(s, 'whisper_text')]
+        pairs = [(s.text.lower(), s.whisper_text.lower()) for s in matched]
+        ratios = similarity.levenshtein_ratios(pairs, cutoff, num_workers)
+        for s, ratio in zip(matched, ratios):
+            s.levenshtein_ratio = ratio
+        similarity.get_cache().save()
+
+    def match_all_segments(self, csv_index = None):
+        '''match all segments with the csv rows in a single join without
+        making episodes, see segment_matcher.match_all_segments
+        the mismatches are stored in match_report
+        '''
+        self.match_report = segment_matcher.match_all_segments(
+            self.segments, csv_index)
+        return self.match_report
 
 class Segment:
     def __init__(self, text, audio_filepath, name, identifier, segment_id,
@@ -140,15 +174,17 @@ class Segment:
 
     def __str__(self):
         m = self.__repr__() + '\n'
-        items = self.__dict__.items()
         o = []
-        for k,v in self.__dict__.items():
+        for k,v in self._str_items():
             if k in ['episode', 'program']: continue
             if k in ['text', 'whisper_text'] and v is not None: 
                 v = textwrap.fill(v, width=80, subsequent_indent=' ' * 20)
             o.append(f'{k:<18}: {v}')
         m += '\n'.join(o)
         return m
+
+    def _str_items(self):
+        return self.__dict__.items()
         
 
     def __gt__(self, other):
@@ -171,33 +207,266 @@ class Segment:
                 d[k] = getattr(self, k)
         return d
 
+class SegmentTable:
+    '''Columnar store of manifest segments.
+    numerical fields are numpy arrays, the repeated strings (name, identifier,
+    tar_filename, manifest_filename, split) are stored as categorical codes
+    into a sorted list of categories.
+    text is stored as concatenated utf-8 bytes with the byte offset of each
+    row (as in csv_episode_index). segment_id is stored as an integer with
+    its string width (zero padding), audio_filepath is rebuilt from its
+    directory and extension (categorical) and name, identifier and
+    segment_id. strings that can not be rebuilt are kept in overrides.
+    the segments are sorted on name, identifier and segment_id
+    table[index] returns a SegmentView, a Segment backed by the table
+    '''
+    categorical_keys = ['name', 'identifier', 'tar_filename',
+        'manifest_filename', 'split']
+    path_keys = ['audio_directory', 'audio_extension']
+    float_keys = ['start_time', 'end_time', 'levenshtein_ratio']
+
+    def __init__(self, entries):
+        '''entries     iterable of manifest entries (see load.iter_manifest)'''
+        keys = self.categorical_keys + self.path_keys
+        lookups = {k: {} for k in keys}
+        codes = {k: array('i') for k in keys}
+        segment_ids, durations = array('q'), array('d')
+        widths, has_name = array('b'), array('b')
+        text, text_offsets = bytearray(), array('q', [0])
+        overrides = {}
+        for row, line in enumerate(entries):
+            directory, filename = os.path.split(line['audio_filepath'])
+            stem, extension = os.path.splitext(filename)
+            line = {**line, 'audio_directory': directory,
+                'audio_extension': extension}
+            for k in keys:
+                lookup = lookups[k]
+                if line[k] not in lookup: lookup[line[k]] = len(lookup)
+                codes[k].append(lookup[line[k]])
+            segment_id = line['segment_id']
+            segment_ids.append(int(segment_id))
+            widths.append(min(len(segment_id), 127))
+            if format_segment_id(segment_ids[-1], widths[-1]) != segment_id:
+                overrides['segment_id', row] = segment_id
+            has_name.append(stem.count('-') == 2)
+            audio_filepath = format_audio_filepath(directory, line['name'],
+                line['identifier'], segment_id, extension, has_name[-1])
+            if audio_filepath != line['audio_filepath']:
+                overrides['audio_filepath', row] = line['audio_filepath']
+            durations.append(line['duration'])
+            text += line['text'].encode()
+            text_offsets.append(len(text))
+        self.categories, self.codes = {}, {}
+        for k in keys:
+            categories = sorted(lookups[k])
+            # smallest unsigned dtype that holds the codes
+            dtype = np.min_scalar_type(max(len(categories) - 1, 0))
+            remap = np.empty(len(categories), dtype = dtype)
+            for code, category in enumerate(categories):
+                remap[lookups[k][category]] = code
+            self.categories[k] = categories
+            self.codes[k] = remap[np.array(codes[k], dtype = np.int32)]
+        segment_ids = np.array(segment_ids, dtype = np.int64)
+        order = np.lexsort((segment_ids, self.codes['identifier'],
+            self.codes['name']))
+        for k in keys:
+            self.codes[k] = self.codes[k][order]
+        self.segment_id = segment_ids[order]
+        self.segment_id_width = np.array(widths, dtype = np.int8)[order]
+        self.has_name = np.array(has_name, dtype = bool)[order]
+        self.duration = np.array(durations, dtype = np.float64)[order]
+        text_offsets = np.array(text_offsets, dtype = np.int64)
+        view = memoryview(text)
+        self.text = b''.join([view[text_offsets[i]:text_offsets[i + 1]] 
+            for i in order.tolist()])
+        lengths = np.diff(text_offsets)[order]
+        self.text_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        position = np.empty(len(order), dtype = np.int64)
+        position[order] = np.arange(len(order))
+        self.overrides = {(k, int(position[row])): v 
+            for (k, row), v in overrides.items()}
+        n = len(order)
+        self.whisper_text = [None] * n
+        self.floats = {k: np.full(n, np.nan) for k in self.float_keys}
+        self.episodes = {}
+        self.programs = {}
+
+    def __repr__(self):
+        return f"<SegmentTable {len(self)} segments>"
+
+    def __len__(self):
+        return len(self.segment_id)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [SegmentView(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0: index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"index {index} out of range")
+        return SegmentView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield SegmentView(self, index)
+
+    def get_category(self, key, index):
+        return self.categories[key][self.codes[key][index]]
+
+    def get_text(self, index):
+        start, end = self.text_offsets[index:index + 2].tolist()
+        return self.text[start:end].decode()
+
+    def get_segment_id(self, index):
+        if ('segment_id', index) in self.overrides:
+            return self.overrides['segment_id', index]
+        return format_segment_id(int(self.segment_id[index]),
+            int(self.segment_id_width[index]))
+
+    def get_audio_filepath(self, index):
+        if ('audio_filepath', index) in self.overrides:
+            return self.overrides['audio_filepath', index]
+        return format_audio_filepath(
+            self.get_category('audio_directory', index),
+            self.get_category('name', index),
+            self.get_category('identifier', index),
+            self.get_segment_id(index),
+            self.get_category('audio_extension', index),
+            self.has_name[index])
+
+def format_segment_id(segment_id, width):
+    '''segment_id string with the zero padding of the manifest filename'''
+    return f'{segment_id:0{width}d}'
+
+def format_audio_filepath(directory, name, identifier, segment_id, 
+    extension, has_name = True):
+    '''inverse of load.audio_filepath_to_info'''
+    stem = f'{identifier}-{segment_id}'
+    if has_name: stem = f'{name}-{stem}'
+    return os.path.join(directory, stem + extension)
+
+def _categorical_property(key):
+    def getter(self):
+        return self.table.get_category(key, self.index)
+    return property(getter)
+
+def _float_property(key):
+    '''optional float field, unset values raise AttributeError
+    so hasattr behaves as for a plain Segment'''
+    def getter(self):
+        value = self.table.floats[key][self.index]
+        if np.isnan(value): raise AttributeError(key)
+        return float(value)
+    def setter(self, value):
+        self.table.floats[key][self.index] = value
+    return property(getter, setter)
+
+class SegmentView(Segment):
+    '''Segment backed by a row of a SegmentTable.'''
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    name = _categorical_property('name')
+    identifier = _categorical_property('identifier')
+    tar_filename = _categorical_property('tar_filename')
+    manifest_filename = _categorical_property('manifest_filename')
+    split = _categorical_property('split')
+    start_time = _float_property('start_time')
+    end_time = _float_property('end_time')
+    levenshtein_ratio = _float_property('levenshtein_ratio')
+
+    @property
+    def text(self):
+        return self.table.get_text(self.index)
+
+    @property
+    def audio_filepath(self):
+        return self.table.get_audio_filepath(self.index)
+
+    @property
+    def duration(self):
+        return float(self.table.duration[self.index])
+
+    @property
+    def segment_id(self):
+        return self.table.get_segment_id(self.index)
+
+    @property
+    def whisper_text(self):
+        value = self.table.whisper_text[self.index]
+        if value is None: raise AttributeError('whisper_text')
+        return value
+
+    @whisper_text.setter
+    def whisper_text(self, value):
+        self.table.whisper_text[self.index] = value
+
+    @property
+    def episode(self):
+        return self.table.episodes.get(self.index)
+
+    @episode.setter
+    def episode(self, value):
+        self.table.episodes[self.index] = value
+
+    @property
+    def program(self):
+        return self.table.programs.get(self.index)
+
+    @program.setter
+    def program(self, value):
+        self.table.programs[self.index] = value
+
+    def _str_items(self):
+        return self.to_json().items()
+
 def identifier_to_episode(identifier, segments, do_match = True, 
     segments_object = None):
     segments = [s for s in segments if s.identifier == identifier]
-    names = list(set([x.name for x in segments]))
-    if len(names) > 1:
+    return _name_groups_to_episode(identifier, _group_on_name(segments),
+        do_match, segments_object)
+
+def _group_on_name(segments):
+    name_groups = {}
+    for segment in segments:
+        name_groups.setdefault(segment.name, []).append(segment)
+    return name_groups
+
+def _name_groups_to_episode(identifier, name_groups, do_match = True,
+    segments_object = None):
+    '''make an Episode from the segments of an identifier grouped on name
+    an identifier with segments from multiple names returns a list of
+    episodes, one per name
+    '''
+    if len(name_groups) > 1:
         episodes = []
+        names = list(name_groups.keys())
         print(f'Warning: identifier {identifier} has segments from ')
         print(f'multiple names: {names}, return multiple episodes')
-        for name in names:
-            sub_segments = [s for s in segments if s.name == name]
+        for sub_segments in name_groups.values():
             episodes.append(Episode(identifier, sub_segments, 
                 segments_object, do_match = do_match))
         return episodes
+    segments = next(iter(name_groups.values())) if name_groups else []
     return Episode(identifier, segments, segments_object, do_match = do_match)
 
 def identifiers_to_episode(identifiers, segments, do_match = True,
     segments_object = None):
-    print('select segments with given identifiers')
-    selection = []
+    '''make the episodes of the given identifiers
+    the segments are grouped on identifier and name in a single pass
+    '''
+    print('group segments with given identifiers')
+    identifier_set = set(identifiers)
+    groups = {}
     for segment in progressbar(segments):
-        if segment.identifier in identifiers:
-            selection.append(segment)
+        if segment.identifier not in identifier_set: continue
+        name_groups = groups.setdefault(segment.identifier, {})
+        name_groups.setdefault(segment.name, []).append(segment)
     episodes = []
     print(f'making {len(identifiers)} episodes')
     for identifier in progressbar(identifiers):
-        episodes.append(identifier_to_episode(identifier, selection, do_match,
-            segments_object))
+        episodes.append(_name_groups_to_episode(identifier, 
+            groups.get(identifier, {}), do_match, segments_object))
     return episodes
 
 
@@ -220,8 +489,9 @@ def make_manifest_programs(segments):
         if d['n_episodes'] == 1:
             other_programs[d['name']] = d
     other_filename = locations.manifest_program_directory / "other_programs.json"
-    with open(other_filename, 'w') as f:
-        json.dump(other_programs, f)
+    with open(other_filename, 'w', encoding='utf-8') as f:
+        json_codec.dump(other_programs, f)
+    similarity.get_cache().save()
 
 def program_names_to_segment_slices(program_names, segments):
     ids = _find_string_ranges(program_names)
@@ -247,8 +517,8 @@ def episodes_to_manifest_program_json(episodes, save = True):
         return d
     if save:
         filename = locations.manifest_program_directory / f"{d['name']}.json"
-        with open(filename, 'w') as f:
-            json.dump(d, f)
+        with open(filename, 'w', encoding='utf-8') as f:
+            json_codec.dump(d, f)
     return d
 
 def _find_string_ranges(sorted_strings):
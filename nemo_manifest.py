@@ -1,8 +1,12 @@
-import json
+import hashlib
+import json_codec
+from multiprocessing import Pool
+import os
 from pathlib import Path
 from progressbar import progressbar
 import load
 import locations
+import tar
 
 def load_subset_5000_clean_segments():
     segments = load.load_subset_5000_clean_segments()
@@ -16,17 +20,12 @@ def make_nemo_manifest(output_filename = None, segments = None,
         if p.exists() and not overwrite:
             print(f"File {p} exists, not overwriting.")
             return
-    d = []
+    formatter = NemoFormatter(audio_base_path, audio_extension, dataset_id)
     print(f'handling {len(segments)} segments')
-    for segment in progressbar(segments):
-        nm = segment_to_nemo_format(segment, audio_base_path, 
-            audio_extension, dataset_id)
-        d.append(nm)
+    d = [formatter.format(segment) for segment in progressbar(segments)]
     if output_filename is not None:
-        with open(p, 'w') as f:
-            for nm in d:
-                json_line = json.dumps(nm)
-                f.write(json_line + '\n')
+        with open(p, 'w', encoding='utf-8') as f:
+            json_codec.write_lines(d, f)
     return d
 
 def segment_to_nemo_format(segment, audio_base_path = None, 
@@ -48,6 +47,148 @@ def segment_to_nemo_format(segment, audio_base_path = None,
     d['dataset'] = dataset_id
     return d
 
+class NemoFormatter:
+    '''formats segments as NeMo manifest dicts (see segment_to_nemo_format)
+    the audio directory of each source tar is computed once and the audio
+    file path is built with string concatenation
+    '''
+    def __init__(self, audio_base_path = None, audio_extension = '.ogg',
+        dataset_id = 7):
+        if audio_base_path is None:
+            audio_base_path = locations.audio_base_path
+        self.audio_base_path = Path(audio_base_path)
+        self.audio_extension = audio_extension
+        self.dataset_id = dataset_id
+        self.prefixes = {}
+
+    def __repr__(self):
+        return f"<NemoFormatter {self.audio_base_path} {len(self.prefixes)} tars>"
+
+    def prefix(self, tar_filename):
+        if tar_filename not in self.prefixes:
+            tf = Path(tar_filename).stem + '_ogg'
+            self.prefixes[tar_filename] = str(self.audio_base_path / tf) + '/'
+        return self.prefixes[tar_filename]
+
+    def format(self, segment):
+        af = segment['audio_filepath'].replace('.wav', self.audio_extension)
+        return {'audio_filepath': self.prefix(segment['tar_filename']) + af,
+            'duration': segment['duration'], 'text': segment['text'],
+            'id': f"{segment['name']}-{segment['identifier']}-"
+                f"{segment['segment_id']}",
+            'dataset': self.dataset_id}
+
+def shard_filenames(output_filename, num_shards):
+    '''output filenames of a sharded manifest, the output filename itself
+    for a single shard, otherwise <stem>_<shard><suffix>'''
+    p = Path(output_filename)
+    if num_shards == 1: return [p]
+    return [p.parent / f'{p.stem}_{i}{p.suffix}' for i in range(num_shards)]
+
+def _iter_line_range(filename, start, end):
+    '''yield the lines of a file that start in the byte range [start, end)'''
+    with open(filename, 'rb') as fin:
+        position = start
+        if start > 0:
+            fin.seek(start - 1)
+            # skip the line that belongs to the previous range
+            position += len(fin.readline()) - 1
+        while position < end:
+            line = fin.readline()
+            if not line: break
+            position += len(line)
+            if line.strip(): yield line
+
+def _write_nemo_shard(args):
+    segments_filename, output_filename, start, end, formatter = args
+    n, duration = 0, 0
+    def records():
+        nonlocal n, duration
+        for line in _iter_line_range(segments_filename, start, end):
+            segment = json_codec.loads(line)
+            n += 1
+            duration += segment['duration']
+            yield formatter.format(segment)
+    with open(output_filename, 'w', encoding='utf-8') as fout:
+        json_codec.write_lines(records(), fout)
+    return n, duration
+
+def make_nemo_manifest_streaming(segments_filename, output_filename,
+    num_shards = 1, num_workers = 1, audio_base_path = None,
+    audio_extension = '.ogg', dataset_id = 7, overwrite = False):
+    '''write the NeMo manifest of a segments jsonl file without loading it
+    segments_filename   segments file relative to locations.BASE_DIR
+    num_shards          number of manifest files (see shard_filenames), 
+                        each shard holds a contiguous part of the segments
+    num_workers         shards are written in parallel with num_workers > 1
+    returns the shard filenames
+    '''
+    filenames = shard_filenames(output_filename, num_shards)
+    if any(f.exists() for f in filenames) and not overwrite:
+        print(f"File {filenames[0]} exists, not overwriting.")
+        return
+    f = locations.BASE_DIR / segments_filename
+    if not f.exists():
+        m = f"segments file {f} does not exist."
+        raise ValueError(m)
+    size = os.path.getsize(f)
+    formatter = NemoFormatter(audio_base_path, audio_extension, dataset_id)
+    tasks = [(f, filenames[i], i * size // num_shards,
+        (i + 1) * size // num_shards, formatter) for i in range(num_shards)]
+    if num_workers > 1 and num_shards > 1:
+        with Pool(processes = min(num_workers, num_shards)) as pool:
+            results = list(progressbar(pool.imap(_write_nemo_shard, tasks),
+                max_value = len(tasks)))
+    else: results = [_write_nemo_shard(task) for task in progressbar(tasks)]
+    n = sum(x[0] for x in results)
+    duration = sum(x[1] for x in results)
+    m = f'wrote {n} segments, {duration/3600:.2f} hours to {num_shards} '
+    m += 'manifest file(s)'
+    print(m)
+    return filenames
+
+def make_source_tar_mapping(segments_filename, output_filename,
+    audio_base_path = None, audio_extension = '.ogg', tar_base_path = None,
+    index_directory = None, overwrite = False):
+    '''map the NeMo manifest audio_filepath of each segment to
+    [source tar filename, data offset, size] so convert_to_tarred_audio_dataset
+    (--source_tar_mapping) can copy the audio from the source tars
+    the offsets are resolved here with the sidecar tar index (each index is
+    loaded once), the builder only reads the bytes
+    segments_filename   segments file relative to locations.BASE_DIR
+    '''
+    p = Path(output_filename)
+    if p.exists() and not overwrite:
+        print(f"File {p} exists, not overwriting.")
+        return
+    if tar_base_path is None: tar_base_path = locations.tar_base_path
+    tar_base_path = Path(tar_base_path)
+    formatter = NemoFormatter(audio_base_path, audio_extension)
+    tar_filenames = {}
+    tar_members = {}
+    for segment in progressbar(load.iter_segments(segments_filename)):
+        key = segment['tar_filename'], segment['org_split']
+        if key not in tar_filenames:
+            tf = f'{Path(key[0]).stem}_ogg.tar'
+            tar_filenames[key] = str(tar_base_path / key[1] / tf)
+            tar_members[tar_filenames[key]] = []
+        member = segment['audio_filepath'].replace('.wav', '.ogg')
+        audio_filepath = formatter.format(segment)['audio_filepath']
+        tar_members[tar_filenames[key]].append((audio_filepath, member))
+    mapping = {}
+    for tar_filename, members in progressbar(tar_members.items()):
+        index = tar.load_tar_index(tar_filename, index_directory)['members']
+        for audio_filepath, member in members:
+            if member not in index:
+                m = f'could not find {member} in {tar_filename}'
+                raise FileNotFoundError(m)
+            _, data_offset, size = index[member]
+            mapping[audio_filepath] = [tar_filename, data_offset, size]
+    with open(p, 'w', encoding='utf-8') as fout:
+        json_codec.dump(mapping, fout)
+    print(f'mapped {len(mapping)} audio files to {len(tar_filenames)} tars')
+    return mapping
+
 def segment_to_tar_audio_file_dict(segment, output_dict = {}, 
     tar_base_path = None):
     if tar_base_path is None:
@@ -70,14 +211,90 @@ def make_tar_audio_file_dict(segments, output_filename = None,
     p = Path(output_filename)
     if p.exists() and not overwrite:
         print(f'Loading existing tar audio file dict from {p}')
-        with open(p) as fin:
-            output_dict = json.load(fin)
+        with open(p, encoding='utf-8') as fin:
+            return json_codec.load(fin)
     print(f'Creating tar audio file dict at {p}')
     output_dict = {}
     for segment in progressbar(segments):
         output_dict = segment_to_tar_audio_file_dict(segment, output_dict,
             tar_base_path)
-    with open(p, 'w') as fout:
-        json.dump(output_dict, fout, indent=2)
+    with open(p, 'w', encoding='utf-8') as fout:
+        json_codec.dump(output_dict, fout, indent=2)
     return output_dict
 
+
+# tar plan: the members to extract per source tar in on-disk order
+
+def selection_hash(segments_filename):
+    '''sha1 of the content of a segments file (relative to BASE_DIR)'''
+    h = hashlib.sha1()
+    with open(locations.BASE_DIR / segments_filename, 'rb') as fin:
+        while True:
+            block = fin.read(1 << 24)
+            if not block: break
+            h.update(block)
+    return h.hexdigest()
+
+def _plan_tar(args):
+    '''return [tar_filename, bytes, members, missing] with the members sorted
+    on data offset, bytes is None if the tar can not be indexed'''
+    tar_filename, member_names, use_index = args
+    if not use_index or not Path(tar_filename).exists():
+        return [tar_filename, None, member_names, []]
+    members = tar.load_tar_index(tar_filename)['members']
+    missing = [name for name in member_names if name not in members]
+    found = sorted(set(member_names) - set(missing),
+        key = lambda name: members[name][1])
+    n_bytes = sum(members[name][2] for name in found)
+    return [tar_filename, n_bytes, found, missing]
+
+def make_tar_plan(segments_filename, output_filename = None,
+    tar_base_path = None, use_index = True, num_workers = 1,
+    overwrite = False):
+    '''group the segments of a segments file on source tar and order the
+    members of each tar on their byte offset (with the sidecar tar index)
+    so a tar is read front to back during extraction
+    the plan is stored as {'selection': selection hash, 'tar_base_path',
+    'total_bytes', 'tars': [[tar_filename, bytes, members, missing], ...]}
+    and is reused if the segment selection did not change
+    '''
+    if output_filename is None:
+        output_filename = locations.BASE_DIR / 'tar_plan_5000h.json'
+    if tar_base_path is None: tar_base_path = locations.tar_base_path
+    p = Path(output_filename)
+    selection = selection_hash(segments_filename)
+    if p.exists() and not overwrite:
+        plan = load_tar_plan(p)
+        if plan['selection'] == selection and \
+            plan['tar_base_path'] == str(tar_base_path):
+            print(f'Loading existing tar plan from {p}')
+            return plan
+        print(f'segment selection changed, remaking tar plan {p}')
+    tar_audio_file_dict = {}
+    for segment in progressbar(load.iter_segments(segments_filename)):
+        segment_to_tar_audio_file_dict(segment, tar_audio_file_dict,
+            tar_base_path)
+    tasks = [(k, v, use_index) for k, v in tar_audio_file_dict.items()]
+    if num_workers > 1:
+        with Pool(processes = num_workers) as pool:
+            tars = list(progressbar(pool.imap(_plan_tar, tasks),
+                max_value = len(tasks)))
+    else: tars = [_plan_tar(task) for task in progressbar(tasks)]
+    total_bytes = sum(t[1] for t in tars if t[1] is not None)
+    plan = {'selection': selection, 'tar_base_path': str(tar_base_path),
+        'total_bytes': total_bytes, 'tars': tars}
+    with open(p, 'w', encoding='utf-8') as fout:
+        json_codec.dump(plan, fout)
+    n_missing = sum(len(t[3]) for t in tars)
+    m = f'tar plan: {len(tars)} tars, {total_bytes / 1024**3:.2f} GB to read'
+    if n_missing: m += f', {n_missing} members not found in their tar'
+    print(m)
+    return plan
+
+def load_tar_plan(filename):
+    with open(filename, encoding='utf-8') as fin:
+        return json_codec.load(fin)
+
+def tar_plan_to_tar_audio_file_dict(plan):
+    '''return {tar_filename: members} with the members in on-disk order'''
+    return {t[0]: t[2] for t in plan['tars']}
@@ -0,0 +1,402 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import json
+import locations
+from pathlib import Path
+import threading
+import time
+
+'''incremental runner for the preprocessing stages
+
+each stage declares its input and output paths and its parameters.
+a stage is only rerun if the fingerprint of its parameters and inputs
+changed since the last run or if an output is missing.
+fingerprints are content hashes, the hash of a file is cached on its
+size and mtime so unchanged files are not read again.
+the stage graph follows from the paths: a stage depends on the stages
+that produce its inputs, independent stages run in parallel.
+'''
+
+class Stage:
+    def __init__(self, name, function, inputs = None, outputs = None,
+        params = None, content_hash = True, run_params = None,
+        resumable = False):
+        '''name            unique stage name
+        function        called as function(**params, **run_params)
+        inputs          list of files or directories read by the stage
+        outputs         list of files or directories written by the stage
+        params          dict of keyword arguments, part of the fingerprint
+        content_hash    fingerprint the outputs on file content, if False
+                        only on file name, size and mtime (for large audio
+                        directories)
+        run_params      dict of keyword arguments that do not change the
+                        outputs (e.g. number of workers), not part of the
+                        fingerprint
+        resumable       function is also called with fingerprint=<stage
+                        fingerprint>, so it can resume an interrupted run
+                        with the same fingerprint and start over otherwise
+        '''
+        self.name = name
+        self.function = function
+        self.inputs = [Path(x) for x in inputs] if inputs else []
+        self.outputs = [Path(x) for x in outputs] if outputs else []
+        self.params = params if params else {}
+        self.run_params = run_params if run_params else {}
+        self.content_hash = content_hash
+        self.resumable = resumable
+        self.depends_on = []
+
+    def __repr__(self):
+        m = f"<Stage {self.name} ({len(self.inputs)} inputs, "
+        m += f"{len(self.outputs)} outputs)>"
+        return m
+
+class Pipeline:
+    def __init__(self, stages, state_filename = None):
+        if state_filename is None:
+            state_filename = locations.BASE_DIR / 'pipeline_state.json'
+        self.state_filename = Path(state_filename)
+        self.stages = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Duplicate stage name {stage.name}")
+            self.stages[stage.name] = stage
+        self._handle_dependencies()
+        self._load_state()
+        self._lock = threading.Lock()
+        self.timings = {}
+
+    def __repr__(self):
+        return f"<Pipeline {len(self.stages)} stages>"
+
+    def _handle_dependencies(self):
+        self.producers = {}
+        for stage in self.stages.values():
+            for output in stage.outputs:
+                if output in self.producers:
+                    m = f"{output} is an output of {self.producers[output]}"
+                    m += f" and {stage.name}"
+                    raise ValueError(m)
+                self.producers[output] = stage.name
+        for stage in self.stages.values():
+            stage.depends_on = sorted(set(self.producers[x]
+                for x in stage.inputs if x in self.producers))
+        self._check_cycles()
+
+    def _check_cycles(self):
+        done, visiting = set(), set()
+        def visit(name):
+            if name in done: return
+            if name in visiting:
+                raise ValueError(f"Stage graph has a cycle at {name}")
+            visiting.add(name)
+            for dependency in self.stages[name].depends_on: visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+        for name in self.stages: visit(name)
+
+    def _load_state(self):
+        if self.state_filename.exists():
+            with open(self.state_filename) as fin:
+                self.state = json.load(fin)
+        else: self.state = {'stages': {}, 'file_hashes': {}}
+
+    def _save_state(self):
+        # stages run in threads, all changes to self.state hold the lock
+        tmp = self.state_filename.parent / f'{self.state_filename.name}.tmp'
+        with self._lock:
+            with open(tmp, 'w') as fout:
+                json.dump(self.state, fout)
+            tmp.replace(self.state_filename)
+
+    def fingerprint(self, path, content_hash = True):
+        '''path_fingerprint with the shared file hash cache, files are hashed
+        on a copy of the cache outside the lock'''
+        with self._lock: file_hashes = dict(self.state['file_hashes'])
+        fingerprint = path_fingerprint(path, file_hashes, content_hash)
+        with self._lock: self.state['file_hashes'].update(file_hashes)
+        return fingerprint
+
+    def input_fingerprint(self, path):
+        '''outputs of an upstream stage use the fingerprint recorded when
+        that stage ran, other inputs are hashed'''
+        if path in self.producers:
+            with self._lock:
+                stage_state = self.state['stages'].get(self.producers[path], {})
+                return stage_state.get('outputs', {}).get(str(path))
+        return self.fingerprint(path)
+
+    def stage_fingerprint(self, stage):
+        d = {'params': stage.params,
+            'inputs': {str(x): self.input_fingerprint(x) for x in stage.inputs},
+            'outputs': [str(x) for x in stage.outputs]}
+        t = json.dumps(d, sort_keys = True, default = str)
+        return hashlib.sha1(t.encode()).hexdigest()
+
+    def is_up_to_date(self, stage, fingerprint):
+        with self._lock: stage_state = self.state['stages'].get(stage.name)
+        if stage_state is None: return False
+        if stage_state['fingerprint'] != fingerprint: return False
+        return all(x.exists() for x in stage.outputs)
+
+    def run_stage(self, stage, force = False):
+        fingerprint = self.stage_fingerprint(stage)
+        if not force and self.is_up_to_date(stage, fingerprint):
+            self.timings[stage.name] = ('up to date', 0.)
+            print(f'{stage.name} is up to date, skipping.')
+            return
+        print(f'running {stage.name}')
+        start = time.time()
+        run_params = dict(stage.run_params)
+        if stage.resumable: run_params['fingerprint'] = fingerprint
+        stage.function(**stage.params, **run_params)
+        outputs = {}
+        for output in stage.outputs:
+            outputs[str(output)] = self.fingerprint(output, stage.content_hash)
+        duration = time.time() - start
+        with self._lock:
+            self.state['stages'][stage.name] = {'fingerprint': fingerprint,
+                'outputs': outputs, 'duration': duration,
+                'finished': time.ctime()}
+        self._save_state()
+        self.timings[stage.name] = ('ran', duration)
+        print(f'{stage.name} done in {duration:.1f} s')
+
+    def run(self, stage_names = None, force = None, num_workers = 2):
+        '''run stage_names (default all) and the stages they depend on
+        force is a list of stage names to rerun even if up to date
+        independent stages are run in parallel in num_workers threads
+        '''
+        force = set(force) if force else set()
+        todo = self._select(stage_names)
+        self.timings = {}
+        done, failed, running = set(), {}, {}
+        with ThreadPoolExecutor(max_workers = num_workers) as executor:
+            while todo or running:
+                for name in sorted(todo):
+                    stage = self.stages[name]
+                    if any(x in failed for x in stage.depends_on):
+                        failed[name] = 'upstream failed'
+                        todo.discard(name)
+                    elif all(x in done for x in stage.depends_on):
+                        future = executor.submit(self.run_stage, stage,
+                            name in force)
+                        running[future] = name
+                        todo.discard(name)
+                if not running: break
+                finished, _ = wait(running, return_when = FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is None: done.add(name)
+                    else:
+                        print(f'{name} failed: {error!r}')
+                        failed[name] = repr(error)
+        for name, error in failed.items():
+            self.timings.setdefault(name, ('failed', 0.))
+        self.report()
+        if failed:
+            raise RuntimeError(f"Stages failed: {failed}")
+
+    def _select(self, stage_names):
+        if stage_names is None: return set(self.stages)
+        selected = set()
+        def add(name):
+            if name in selected: return
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name}")
+            selected.add(name)
+            for dependency in self.stages[name].depends_on: add(dependency)
+        for name in stage_names: add(name)
+        return selected
+
+    def report(self):
+        '''print the status and duration of the stages of the last run'''
+        print(f"{'stage':<24} {'status':<12} {'seconds':>10}")
+        for name, (status, duration) in self.timings.items():
+            print(f'{name:<24} {status:<12} {duration:>10.1f}')
+        total = sum(duration for _, duration in self.timings.values())
+        print(f"{'total':<24} {'':<12} {total:>10.1f}")
+
+def file_hash(path, file_hashes):
+    '''sha1 of the file content, cached in file_hashes on size and mtime'''
+    stat = path.stat()
+    cached = file_hashes.get(str(path))
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+        return cached[2]
+    h = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            h.update(block)
+    digest = h.hexdigest()
+    file_hashes[str(path)] = [stat.st_size, stat.st_mtime, digest]
+    return digest
+
+def path_fingerprint(path, file_hashes, content_hash = True):
+    '''fingerprint of a file or of all files in a directory
+    returns None if the path does not exist
+    '''
+    path = Path(path)
+    if not path.exists(): return None
+    if path.is_file(): files = [path]
+    else: files = sorted(x for x in path.rglob('*') if x.is_file())
+    h = hashlib.sha1()
+    for f in files:
+        h.update(str(f.relative_to(path) if f != path else f.name).encode())
+        if content_hash: h.update(file_hash(f, file_hashes).encode())
+        else:
+            stat = f.stat()
+            h.update(f'{stat.st_size} {stat.st_mtime}'.encode())
+    return h.hexdigest()
+
+# preprocessing stages
+# modules are imported inside the stage functions: importing programs creates
+# a directory and convert_to_tarred_audio_dataset needs the NeMo dependencies
+
+def _csv_episode_index():
+    import csv_episode_index
+    csv_episode_index.make_csv_episode_index()
+
+def _csv_programs():
+    import programs
+    programs.make_program_files()
+
+def _manifest_programs():
+    import manifest
+    manifest.make_manifest_programs(manifest.Segments())
+
+def _programs(num_workers, fingerprint):
+    import hallucinations
+    # the journal is kept (resumed) as long as the stage fingerprint is equal
+    hallucinations.handle_manifest_programs_mp(overwrite = False,
+        num_workers = num_workers, journal_key = fingerprint)
+
+def _filter_segments(max_coverage, num_workers):
+    import segments
+    segments.filter_segments_streaming(max_coverage = max_coverage,
+        num_workers = num_workers)
+
+def _subset(duration_hours, seed, filename):
+    import load
+    import segments
+    clean = load.load_segments('segments.json')
+    subset = segments.shuffle_and_subset(clean, duration_hours, seed)
+    segments.save_segments_list(subset, filename, overwrite = True)
+
+def _nemo_manifest(segments_filename, output_filename, dataset_id):
+    import nemo_manifest
+    nemo_manifest.make_nemo_manifest_streaming(segments_filename,
+        output_filename, dataset_id = dataset_id, overwrite = True)
+
+def _tar_plan(segments_filename, output_filename, num_workers):
+    import nemo_manifest
+    nemo_manifest.make_tar_plan(segments_filename, output_filename,
+        num_workers = num_workers)
+
+def _extract_audio(tar_plan_filename, num_workers):
+    import nemo_manifest
+    import tar
+    plan = nemo_manifest.load_tar_plan(tar_plan_filename)
+    tar_audio_file_dict = nemo_manifest.tar_plan_to_tar_audio_file_dict(plan)
+    tar_bytes = {t[0]: t[1] for t in plan['tars']}
+    tar.extract_files_scheduled(tar_audio_file_dict, 
+        locations.audio_base_path, tar_bytes, max_workers = num_workers,
+        start_workers = max(1, num_workers // 2))
+
+def _source_tar_mapping(segments_filename, output_filename):
+    import nemo_manifest
+    nemo_manifest.make_source_tar_mapping(segments_filename, output_filename,
+        overwrite = True)
+
+def _tarred_dataset(manifest_path, target_dir, num_shards, max_duration,
+    min_duration, shuffle_seed, workers, source_tar_mapping = None):
+    import convert_to_tarred_audio_dataset as convert
+    if source_tar_mapping is not None:
+        source_tar_mapping = str(source_tar_mapping)
+    convert.create_tar_datasets(manifest_path = str(manifest_path),
+        target_dir = str(target_dir), num_shards = num_shards,
+        max_duration = max_duration, min_duration = min_duration,
+        shuffle = True, shuffle_seed = shuffle_seed, sort_in_shards = True,
+        source_tar_mapping = source_tar_mapping, workers = workers)
+
+def make_stages(duration_hours = 5000, seed = 42, max_coverage = 0.3,
+    dataset_id = 7, num_workers = 6, num_shards = 1024, max_duration = 30.0,
+    min_duration = 0.2, from_source_tars = False):
+    '''the preprocessing stages from the whisper csv files to the tarred
+    NeMo dataset
+    from_source_tars    copy the audio from the source tars into the shards
+                        instead of extracting it to locations.audio_base_path
+    '''
+    base = locations.BASE_DIR
+    csv_files = [locations.csv_test, locations.csv_validation,
+        locations.csv_train]
+    segment_files = [base / 'segments.json',
+        base / 'hallucination_segments.json', base / 'no_text_segments.json']
+    subset_filename = base / f'clean_{duration_hours}h_segments.json'
+    nemo_filename = base / f'nemo_manifest_bg_{duration_hours}h.jsonl'
+    tar_plan_filename = base / f'tar_plan_{duration_hours}h.json'
+    mapping_filename = base / f'source_tar_mapping_{duration_hours}h.json'
+    tarred_directory = locations.tarred_dataset_directory
+    tarred_directory = tarred_directory / f'{duration_hours}h'
+    stages = [
+        Stage('csv_episode_index', _csv_episode_index, csv_files,
+            [locations.csv_episode_index_directory]),
+        Stage('csv_programs', _csv_programs,
+            [locations.csv_episode_index_directory],
+            [locations.csv_program_directory]),
+        Stage('manifest_programs', _manifest_programs,
+            [locations.test, locations.validation, locations.train,
+            locations.csv_program_directory],
+            [locations.manifest_program_directory]),
+        Stage('programs', _programs, [locations.manifest_program_directory,
+            locations.program_names_filename], [locations.program_directory],
+            run_params = {'num_workers': num_workers}, resumable = True),
+        Stage('filter_segments', _filter_segments,
+            [locations.program_directory, locations.program_names_filename],
+            segment_files,
+            {'max_coverage': max_coverage},
+            run_params = {'num_workers': num_workers}),
+        Stage('subset', _subset, [segment_files[0]], [subset_filename],
+            {'duration_hours': duration_hours, 'seed': seed,
+            'filename': subset_filename.name}),
+        Stage('nemo_manifest', _nemo_manifest, [subset_filename],
+            [nemo_filename], {'segments_filename': subset_filename.name,
+            'output_filename': nemo_filename, 'dataset_id': dataset_id}),
+    ]
+    tarred_params = {'manifest_path': nemo_filename,
+        'target_dir': tarred_directory, 'num_shards': num_shards,
+        'max_duration': max_duration, 'min_duration': min_duration,
+        'shuffle_seed': seed}
+    tarred_run_params = {'workers': num_workers}
+    if from_source_tars:
+        tarred_params['source_tar_mapping'] = mapping_filename
+        stages += [
+            Stage('source_tar_mapping', _source_tar_mapping, [subset_filename],
+                [mapping_filename], {'segments_filename': subset_filename.name,
+                'output_filename': mapping_filename}),
+            Stage('tarred_dataset', _tarred_dataset,
+                [nemo_filename, mapping_filename], [tarred_directory],
+                tarred_params, content_hash = False,
+                run_params = tarred_run_params),
+        ]
+        return stages
+    stages += [
+        Stage('tar_plan', _tar_plan, [subset_filename],
+            [tar_plan_filename], {'segments_filename': subset_filename.name,
+            'output_filename': tar_plan_filename},
+            run_params = {'num_workers': num_workers}),
+        Stage('extract_audio', _extract_audio, [tar_plan_filename],
+            [locations.audio_base_path],
+            {'tar_plan_filename': tar_plan_filename}, content_hash = False,
+            run_params = {'num_workers': num_workers}),
+        Stage('tarred_dataset', _tarred_dataset,
+            [nemo_filename, locations.audio_base_path], [tarred_directory],
+            tarred_params, content_hash = False,
+            run_params = tarred_run_params),
+    ]
+    return stages
+
+def make_pipeline(**kwargs):
+    '''return a Pipeline of the preprocessing stages, kwargs are passed
+    to make_stages'''
+    return Pipeline(make_stages(**kwargs))
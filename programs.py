@@ -1,16 +1,15 @@
-from collections import Counter
-import json
+from concurrent.futures import ThreadPoolExecutor
+import csv_episode_index
+import json_codec
 import load
 import locations
 from progressbar import progressbar
 
 '''preprocessing module'''
 
+locations.csv_program_directory.mkdir(exist_ok=True)
 locations.program_directory.mkdir(exist_ok=True)
 
-def _find_episode_indices(name, names):
-    return [i for i, x in enumerate(names) if x == name]
-
 def csv_episode_dict_to_names(d):
     names = [k.split('-')[0] for k in d.keys()]
     return names
@@ -19,38 +18,46 @@ def csv_episode_dict_to_episode_ids(d):
     episode_ids = [k.split('-')[-1] for k in d.keys()]
     return episode_ids
 
-def make_program_files(d = None, names = None):
+def make_program_files(d = None, names = None, num_workers = 8):
     '''make program json files from the csv episode dict
-    the program files are stored in locations.program_directory
+    the program files are stored in locations.csv_program_directory
     they are based on the csv files with whisper metadata
+    d is the csv episode dict, default is the binary csv episode index
+    the episodes are grouped on program in a single pass and the program
+    files are written by num_workers threads
     '''
     if d is None:
-        d = load.make_or_load_csv_episode_dict()
+        d = csv_episode_index.make_or_load()
     if names is None:
         names = csv_episode_dict_to_names(d)
     episode_ids = csv_episode_dict_to_episode_ids(d)
-    program_names = list(set(names))
+    program_episode_ids = {}
+    for name, episode_id in zip(names, episode_ids):
+        program_episode_ids.setdefault(name, []).append(episode_id)
     other_programs = {}
-    for name in progressbar(program_names):
-        indices = _find_episode_indices(name, names)
-        program_episode_ids = [episode_ids[i] for i in indices]
-        if len(program_episode_ids) == 1:
-            program = handle_program(name, program_episode_ids, d, save=False)
-            other_programs[name] = program
-        else:
-            handle_program(name, program_episode_ids, d, save=True)
-    other_filename = locations.program_directory / "other_programs.json"
+    multi_episode = []
+    for name, ids in program_episode_ids.items():
+        if len(ids) == 1:
+            other_programs[name] = handle_program(name, ids, d, save=False)
+        else: multi_episode.append(name)
+    with ThreadPoolExecutor(max_workers = num_workers) as executor:
+        futures = [executor.submit(handle_program, name, 
+            program_episode_ids[name], d, save=True) 
+            for name in multi_episode]
+        for future in progressbar(futures):
+            future.result()
+    other_filename = locations.csv_program_directory / "other_programs.json"
     m = f"Writing other programs file {other_filename} with "
     m += f"{len(other_programs)} programs."
     print(m)
-    with open(other_filename, 'w') as f:
-        json.dump(other_programs, f)
+    with open(other_filename, 'w', encoding='utf-8') as f:
+        json_codec.dump(other_programs, f)
 
 
 def handle_program(name, program_episode_ids, d, save = True):
     '''make a single program json file with all associated episodes
     '''
-    filename = locations.program_directory / f"{name}.json"
+    filename = locations.csv_program_directory / f"{name}.json"
     episodes = {eid: d[name+'-'+eid] for eid in program_episode_ids}
     duration = 0
     n_segments = 0
@@ -71,8 +78,8 @@ def handle_program(name, program_episode_ids, d, save = True):
         m = f"Writing program file {filename} with {len(program_episode_ids)}."
         m += f" episodes, {n_segments} segments, {duration/3600:.2f} hours."
         print(m)
-        with open(filename, 'w') as f:
-            json.dump(program_dict, f)
+        with open(filename, 'w', encoding='utf-8') as f:
+            json_codec.dump(program_dict, f)
     return program_dict
 
 def _make_program_info(overwrite = False):
@@ -97,8 +104,8 @@ def _make_program_info(overwrite = False):
         program['total_duration_hours'] = program['total_duration'] / 3600
         del program['total_duration']
         output[name] = program
-    with open(locations.program_info_filename, 'w') as f:
-        json.dump(output, f, indent=4)
+    with open(locations.program_info_filename, 'w', encoding='utf-8') as f:
+        json_codec.dump(output, f, indent=4)
         
     
 def load_program(name, other_programs = None):
@@ -1,3 +1,6 @@
+import csv_episode_index
+import numpy as np
+import pandas as pd
 from progressbar import progressbar
 
 '''preprocessing module'''
@@ -58,3 +61,98 @@ def check_identifier(manifest_segments, csv_segments, identifier):
     if cids[0] != identifier:
         m += f" Expected {identifier}, found {cids}"
         raise ValueError(m)
+
+def match_all_segments(segments, csv_index = None, tolerance = 0.1,
+    sample_rate = 16000):
+    '''match all manifest segments with the csv rows in one join
+    segments    manifest.SegmentTable or list of Segment objects
+    csv_index   csv_episode_index.CsvEpisodeIndex (default loaded from disk)
+
+    manifest segments and csv rows are aligned on episode key 
+    (name-identifier) and position within the episode (manifest segments
+    ordered on segment_id, csv rows in file order) as in
+    match_episode_segments. an episode is only matched if the number of
+    segments agree and all durations are within tolerance, whisper_text,
+    start_time and end_time are then set for all its segments.
+    returns a DataFrame with a row for every mismatch
+    '''
+    if csv_index is None:
+        csv_index = csv_episode_index.make_or_load()
+    m = _manifest_frame(segments)
+    c = pd.DataFrame({'key': csv_index.row_episode_keys(),
+        'segment_index': csv_index.row_segment_index(),
+        'row': np.arange(csv_index.starts[-1]),
+        'csv_duration': csv_index.values(csv_index.columns[-3])})
+    df = m.merge(c, on = ['key', 'segment_index'], how = 'outer',
+        indicator = True)
+    counts = df.groupby('key')['_merge'].value_counts().unstack(fill_value=0)
+    for column in ['both', 'left_only', 'right_only']:
+        if column not in counts: counts[column] = 0
+    count_mismatch = counts[(counts['left_only'] > 0) | 
+        (counts['right_only'] > 0)]
+    count_report = pd.DataFrame({'key': count_mismatch.index,
+        'reason': 'count',
+        'manifest_segments': count_mismatch['both'] + count_mismatch['left_only'],
+        'csv_segments': count_mismatch['both'] + count_mismatch['right_only']})
+    both = df[df['_merge'] == 'both']
+    bad_duration = (both['duration'] - both['csv_duration']).abs() > tolerance
+    bad_duration &= ~both['key'].isin(count_report['key'])
+    duration_report = both.loc[bad_duration, ['key', 'segment_index',
+        'duration', 'csv_duration']].assign(reason = 'duration')
+    bad_keys = set(count_report['key']) | set(duration_report['key'])
+    good = both[~both['key'].isin(bad_keys)]
+    # the outer join makes the columns float, they have no missing values
+    # for the matched rows
+    _fill_segments(segments, csv_index, good['position'].to_numpy(np.int64),
+        good['row'].to_numpy(np.int64), sample_rate)
+    report = pd.concat([count_report, duration_report], ignore_index = True)
+    m = f'matched {len(good)} segments, {len(bad_keys)} episodes with '
+    m += f'mismatches ({len(count_report)} count, '
+    m += f'{duration_report["key"].nunique()} duration)'
+    print(m)
+    return report
+
+def _manifest_frame(segments):
+    '''episode key, segment_index and duration of all manifest segments
+    position is the index of the segment in segments'''
+    if hasattr(segments, 'codes'):
+        t = segments
+        names = np.array(t.categories['name'], dtype=object)[t.codes['name']]
+        identifiers = np.array(t.categories['identifier'], 
+            dtype=object)[t.codes['identifier']]
+        keys = names + '-' + identifiers
+        segment_ids, durations = t.segment_id, t.duration
+    else:
+        keys = [f'{s.name}-{s.identifier}' for s in segments]
+        segment_ids = [int(s.segment_id) for s in segments]
+        durations = [s.duration for s in segments]
+    m = pd.DataFrame({'key': keys, 'segment_id': segment_ids,
+        'duration': durations, 'position': np.arange(len(keys))})
+    m = m.sort_values(['key', 'segment_id'], kind = 'stable')
+    m['segment_index'] = m.groupby('key').cumcount()
+    return m
+
+def _fill_segments(segments, csv_index, positions, rows, sample_rate):
+    columns = csv_index.columns
+    texts = csv_index.values(columns[3], rows)
+    start_times = [round(x / sample_rate, 3) for x in 
+        csv_index.values(columns[1], rows).tolist()]
+    end_times = [round(x / sample_rate, 3) for x in 
+        csv_index.values(columns[2], rows).tolist()]
+    if hasattr(segments, 'codes'):
+        t = segments
+        for position, text in zip(positions.tolist(), texts):
+            t.whisper_text[position] = _strip(text)
+        t.floats['start_time'][positions] = start_times
+        t.floats['end_time'][positions] = end_times
+        return
+    for position, text, start, end in zip(positions.tolist(), texts, 
+        start_times, end_times):
+        s = segments[position]
+        s.whisper_text = _strip(text)
+        s.start_time = start
+        s.end_time = end
+
+def _strip(text):
+    # pandas reads an empty transcription as nan
+    return text.strip() if isinstance(text, str) else ''
@@ -1,6 +1,10 @@
-import json
+import hashlib
+import json_codec
 import load
 import locations
+from multiprocessing import Pool
+import numpy as np
+import os
 from progressbar import progressbar
 import random
 
@@ -8,7 +12,7 @@ import random
 def load_program_dict():
     return load.load_program_dict()
 
-def filter_segments(program_dict = None, save = False):
+def filter_segments(program_dict = None, save = False, max_coverage = 0.3):
     if program_dict is None:
         program_dict = load_program_dict()
     filtered = {}
@@ -18,18 +22,87 @@ def filter_segments(program_dict = None, save = False):
     for program_name, program in progressbar(program_dict.items()):
         for episode_id, episode in program['episodes'].items():
             for segment in episode['segments']:
-                if segment['ngram_ratio'] is None:
-                    no_text.append(segment)
-                elif segment['ngram_ratio'] > 0.3:
-                    hallucinations.append(segment)
+                i = _segment_category(segment, max_coverage)
+                if i == 2: no_text.append(segment)
+                elif i == 1: hallucinations.append(segment)
                 else: clean.append(segment)
     if save:
-        save_segments_list(clean, 'segments.json', overwrite = True)
-        save_segments_list(hallucinations, 'hallucination_segments.json', 
-            overwrite = True)
-        save_segments_list(no_text, 'no_text_segments.json', overwrite = True)
+        for segments, filename in zip([clean, hallucinations, no_text],
+            filtered_filenames):
+            save_segments_list(segments, filename, overwrite = True)
     return clean, hallucinations, no_text
 
+filtered_filenames = ['segments.json', 'hallucination_segments.json',
+    'no_text_segments.json']
+
+def _segment_category(segment, max_coverage):
+    '''0 clean, 1 hallucination, 2 no text'''
+    if segment['ngram_ratio'] is None: return 2
+    if segment['ngram_ratio'] > max_coverage: return 1
+    return 0
+
+def _filter_programs_to_files(names, filenames, max_coverage):
+    '''route the segments of the programs one program at a time to the
+    clean, hallucination and no text files'''
+    counts = [0, 0, 0]
+    fouts = [open(f, 'w', encoding='utf-8') for f in filenames]
+    try:
+        for name in names:
+            program = load.load_program(name)
+            for episode in program['episodes'].values():
+                for segment in episode['segments']:
+                    i = _segment_category(segment, max_coverage)
+                    fouts[i].write(json_codec.dumps(segment) + '\n')
+                    counts[i] += 1
+    finally:
+        for fout in fouts: fout.close()
+    return counts
+
+def _filter_worker(args):
+    return _filter_programs_to_files(*args)
+
+def filter_segments_streaming(names = None, max_coverage = 0.3, 
+    num_workers = 1):
+    '''streaming variant of filter_segments with save = True
+    programs are read one at a time and their segments are written directly
+    to the clean, hallucination and no text files, so memory does not grow
+    with the corpus. with num_workers > 1 each worker handles a contiguous
+    chunk of programs and writes its own part files, which are concatenated
+    in order at the end (same output as a single worker)
+    '''
+    if names is None:
+        names = load.load_program_names()
+    filenames = [locations.BASE_DIR / f for f in filtered_filenames]
+    if num_workers <= 1:
+        counts = _filter_programs_to_files(progressbar(names), filenames,
+            max_coverage)
+    else:
+        chunk = -(-len(names) // num_workers)
+        tasks = []
+        for i in range(num_workers):
+            parts = [f.parent / f'{f.name}.part{i}' for f in filenames]
+            tasks.append((names[i * chunk:(i + 1) * chunk], parts, 
+                max_coverage))
+        with Pool(processes=num_workers) as pool:
+            results = pool.map(_filter_worker, tasks)
+        counts = [sum(x) for x in zip(*results)]
+        for j, f in enumerate(filenames):
+            _concatenate_files([task[1][j] for task in tasks], f)
+    m = f'clean {counts[0]}, hallucinations {counts[1]}, '
+    m += f'no text {counts[2]} segments'
+    print(m)
+    return counts
+
+def _concatenate_files(part_filenames, filename):
+    with open(filename, 'wb') as fout:
+        for part in part_filenames:
+            with open(part, 'rb') as fin:
+                while True:
+                    block = fin.read(1 << 24)
+                    if not block: break
+                    fout.write(block)
+            os.remove(part)
+
 def segment_list_to_duration(segments):
     duration = []
     for segment in segments:
@@ -41,10 +114,8 @@ def save_segments_list(segments, filename, overwrite = False):
     if p.exists() and not overwrite:
         print(f"File {p} exists, not overwriting.")
         return
-    with open(p, 'w') as f:
-        for segment in segments:
-            json_line = json.dumps(segment)
-            f.write(json_line + '\n')
+    with open(p, 'w', encoding='utf-8') as f:
+        json_codec.write_lines(segments, f)
 
 def load_clean_segments():
     return load.load_clean_segments()
@@ -76,6 +147,148 @@ def shuffle_and_subset(segments = None, duration_hours = 5000, seed = 42):
     print(m)
     return subset
 
+def duration_subset_indices(durations, duration_hours = 5000, seed = 42,
+    groups = None, max_group_hours = None):
+    '''select a random subset of segments with a total duration of at most
+    duration_hours, working on the durations array only
+    durations       segment durations in seconds
+    groups          optional group label per segment (e.g. program or split)
+    max_group_hours cap on the selected hours per group, a number for all
+                    groups or a dict group -> hours (missing groups no cap)
+    returns the selected indices in random order, the same seed gives the
+    same selection
+    '''
+    durations = np.asarray(durations, dtype=np.float64)
+    duration_seconds = duration_hours * 3600
+    total_dur = durations.sum()
+    if total_dur <= duration_seconds:
+        m = f'Total duration {total_dur/3600:.2f} hours is less than '
+        m += f'requested {duration_hours} hours.'
+        raise ValueError(m)
+    order = np.random.default_rng(seed).permutation(len(durations))
+    if groups is not None and max_group_hours is not None:
+        order = _apply_group_caps(order, durations, groups, max_group_hours)
+    cumulative = np.cumsum(durations[order])
+    if len(cumulative) == 0 or cumulative[-1] <= duration_seconds:
+        capped = cumulative[-1] if len(cumulative) else 0.
+        m = f'Total duration {capped/3600:.2f} hours after applying the '
+        m += f'group caps is less than requested {duration_hours} hours.'
+        raise ValueError(m)
+    n = np.searchsorted(cumulative, duration_seconds, side='right')
+    return order[:n]
+
+def _apply_group_caps(order, durations, groups, max_group_hours):
+    '''drop segments (in the order of order) once their group exceeds
+    its cap'''
+    labels, codes = np.unique(np.asarray(groups)[order], return_inverse=True)
+    if isinstance(max_group_hours, dict):
+        caps = np.array([max_group_hours.get(x, np.inf) for x in labels])
+    else: caps = np.full(len(labels), max_group_hours, dtype=np.float64)
+    caps = caps * 3600
+    # cumulative duration per group, in the order of order
+    by_group = np.argsort(codes, kind='stable')
+    d = durations[order][by_group]
+    cumulative = np.cumsum(d)
+    group_start = np.searchsorted(codes[by_group], np.arange(len(labels)))
+    offsets = np.concatenate([[0], cumulative])[group_start]
+    group_cumulative = np.empty(len(order))
+    group_cumulative[by_group] = cumulative - offsets[codes[by_group]]
+    return order[group_cumulative <= caps[codes]]
+
+def sample_subset(segments = None, duration_hours = 5000, seed = 42,
+    group_key = None, max_group_hours = None):
+    '''numpy variant of shuffle_and_subset, see duration_subset_indices
+    group_key       segment key to cap the hours per group on (e.g. 'name')
+    '''
+    if segments is None:
+        segments = load_clean_segments()
+    durations = segment_list_to_duration(segments)
+    groups = [s[group_key] for s in segments] if group_key else None
+    indices = duration_subset_indices(durations, duration_hours, seed, 
+        groups, max_group_hours)
+    subset = [segments[i] for i in indices]
+    selected = sum(durations[i] for i in indices)
+    m = f'selected {len(subset)} of {len(segments)} segments, '
+    m += f'{selected/3600:.2f} hours.'
+    print(m)
+    return subset
+
+def segment_hash_fraction(segment, key = 'bg-nemo'):
+    '''keyed hash of the segment id (name-identifier-segment_id) mapped to
+    a number in [0, 1), independent of the other segments in the corpus'''
+    segment_id = '-'.join([segment['name'], segment['identifier'], 
+        str(segment['segment_id'])])
+    h = hashlib.blake2b(segment_id.encode(), digest_size = 8, 
+        key = key.encode())
+    return int.from_bytes(h.digest(), 'big') / 2**64
+
+def hash_threshold_for_hours(filename = 'segments.json', duration_hours = 5000,
+    key = 'bg-nemo'):
+    '''return the hash threshold at which the segments with a hash fraction
+    below it add up to duration_hours, in a single streaming pass
+    '''
+    dtype = [('fraction', np.float64), ('duration', np.float64)]
+    values = np.fromiter(((segment_hash_fraction(segment, key), 
+        segment['duration']) for segment in 
+        progressbar(load.iter_segments(filename))), dtype = dtype)
+    fractions = values['fraction']
+    order = np.argsort(fractions)
+    cumulative = np.cumsum(values['duration'][order])
+    duration_seconds = duration_hours * 3600
+    if cumulative[-1] <= duration_seconds:
+        m = f'Total duration {cumulative[-1]/3600:.2f} hours is less than '
+        m += f'requested {duration_hours} hours.'
+        raise ValueError(m)
+    n = np.searchsorted(cumulative, duration_seconds, side='right')
+    return float(fractions[order[n]])
+
+def hash_subset(input_filename = 'segments.json', output_filename = None,
+    duration_hours = 5000, key = 'bg-nemo', threshold = None, 
+    overwrite = False, retune = False):
+    '''select the segments whose keyed hash fraction is below a threshold
+    and stream them to output_filename
+    the selection of a segment only depends on its own id, so subsets for
+    more hours contain the subsets for fewer hours, and adding programs to
+    the corpus keeps the existing selection if the threshold is kept.
+    the threshold is stored next to the output and reused on later runs
+    overwrite   rewrite an existing output (e.g. after adding programs)
+                with the stored threshold
+    threshold   use this threshold instead of the stored one
+    retune      choose a new threshold for duration_hours (see 
+                hash_threshold_for_hours), this can drop segments that were
+                selected before
+    '''
+    if output_filename is None:
+        output_filename = f'clean_{duration_hours}h_hash_segments.json'
+    p = locations.BASE_DIR / output_filename
+    threshold_filename = p.parent / f'{p.stem}_threshold.json'
+    if p.exists() and not overwrite:
+        print(f"File {p} exists, not overwriting.")
+        return
+    if threshold is None and threshold_filename.exists() and not retune:
+        with open(threshold_filename, encoding='utf-8') as fin:
+            info = json_codec.load(fin)
+        if info['key'] != key:
+            raise ValueError(f'{threshold_filename} uses key {info["key"]}')
+        threshold = info['threshold']
+        print(f'using threshold {threshold} from {threshold_filename}')
+    if threshold is None:
+        threshold = hash_threshold_for_hours(input_filename, duration_hours,
+            key)
+    n, selected_duration = 0, 0
+    with open(p, 'w', encoding='utf-8') as fout:
+        for segment in progressbar(load.iter_segments(input_filename)):
+            if segment_hash_fraction(segment, key) >= threshold: continue
+            fout.write(json_codec.dumps(segment) + '\n')
+            n += 1
+            selected_duration += segment['duration']
+    with open(threshold_filename, 'w', encoding='utf-8') as fout:
+        json_codec.dump({'threshold': threshold, 'key': key,
+            'duration_hours': duration_hours}, fout)
+    m = f'selected {n} segments, {selected_duration/3600:.2f} hours, '
+    m += f'threshold {threshold}'
+    print(m)
+
 def subset_5000_clean(overwrite = False):
     f = locations.BASE_DIR / 'clean_5000h_segments.json'
     if f.exists() and not overwrite:
@@ -0,0 +1,89 @@
+import hashlib
+import json_codec
+import Levenshtein
+import locations
+from multiprocessing import Pool
+from progressbar import progressbar
+
+'''batch Levenshtein ratio of transcript pairs
+
+ratios are cached on a hash of both texts (and the cutoff), the cache is
+stored in locations.similarity_cache_filename so rerunning the matching on
+unchanged transcripts does not recompute them.
+with a cutoff only the threshold decision is needed: ratios below the
+cutoff are returned as 0, which lets Levenshtein stop early.
+'''
+
+def text_pair_key(a, b, cutoff = None):
+    h = hashlib.blake2b(digest_size = 12)
+    h.update(a.encode())
+    h.update(b'\0')
+    h.update(b.encode())
+    key = h.hexdigest()
+    if cutoff is not None: key = f'{cutoff}:{key}'
+    return key
+
+class SimilarityCache:
+    def __init__(self, filename = None):
+        if filename is None:
+            filename = locations.similarity_cache_filename
+        self.filename = filename
+        self.ratios = {}
+        self.changed = False
+        if filename.exists():
+            with open(filename, encoding='utf-8') as f:
+                self.ratios = json_codec.load(f)
+
+    def __repr__(self):
+        return f"<SimilarityCache {len(self.ratios)} ratios>"
+
+    def get(self, key):
+        return self.ratios.get(key)
+
+    def put(self, key, ratio):
+        self.ratios[key] = ratio
+        self.changed = True
+
+    def save(self):
+        if not self.changed: return
+        tmp = self.filename.parent / f'{self.filename.name}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json_codec.dump(self.ratios, f)
+        tmp.replace(self.filename)
+        self.changed = False
+
+_cache = None
+
+def get_cache():
+    '''return the shared cache, loaded on first use'''
+    global _cache
+    if _cache is None: _cache = SimilarityCache()
+    return _cache
+
+def _ratio(args):
+    a, b, cutoff = args
+    if cutoff is None: return Levenshtein.ratio(a, b)
+    return Levenshtein.ratio(a, b, score_cutoff = cutoff)
+
+def levenshtein_ratios(pairs, cutoff = None, num_workers = 1, cache = None,
+    chunksize = 1000):
+    '''return the Levenshtein ratio of each (text, text) pair
+    cutoff          ratios below cutoff are returned as 0
+    num_workers     if > 1 uncached pairs are computed in a process pool
+    cache           SimilarityCache, default the shared cache
+    '''
+    if cache is None: cache = get_cache()
+    keys = [text_pair_key(a, b, cutoff) for a, b in pairs]
+    ratios = [cache.get(key) for key in keys]
+    todo = [i for i, ratio in enumerate(ratios) if ratio is None]
+    if not todo: return ratios
+    args = [(pairs[i][0], pairs[i][1], cutoff) for i in todo]
+    if num_workers > 1:
+        with Pool(processes = num_workers) as pool:
+            computed = list(progressbar(pool.imap(_ratio, args,
+                chunksize = chunksize), max_value = len(args)))
+    else: computed = [_ratio(x) for x in args]
+    for i, ratio in zip(todo, computed):
+        ratios[i] = ratio
+        cache.put(keys[i], ratio)
+    return ratios
@@ -1,18 +1,25 @@
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+import json_codec
+import locations
+import multiprocessing
 from multiprocessing import Pool
+import os
 from pathlib import Path
 from progressbar import progressbar
 import tarfile
+import threading
 import time
 from tqdm import tqdm
 
-def _runner(args, output_path, verbose, check_existing):
+def _runner(args, output_path, verbose, check_existing, single_pass):
     tar_file_path, member_names = args
     return extract_files(tar_file_path, member_names, output_path, verbose,
-        check_existing)
+        check_existing, single_pass)
 
 def extract_files_with_tar_audio_file_dict_mp(tar_audio_file_dict,
-    output_path, num_workers = 6, verbose = False, check_existing = True):
+    output_path, num_workers = 6, verbose = False, check_existing = True,
+    single_pass = True):
     items = tar_audio_file_dict.items()
     print(time.ctime(), len(items), num_workers)
     with Pool(processes=num_workers) as pool:
@@ -20,19 +27,212 @@ def extract_files_with_tar_audio_file_dict_mp(tar_audio_file_dict,
         for r in tqdm(
             pool.imap_unordered(
                 partial(_runner, output_path = output_path, verbose = verbose,
-                    check_existing = check_existing),
+                    check_existing = check_existing, single_pass = single_pass),
                 items, chunksize = 1), 
                 total= len(items)):
             results.append(r)
             print(r, 'done', len(results), len(items), time.ctime())
 
+class ThroughputController:
+    '''hill climbing on the number of tars extracted concurrently
+    every window seconds the throughput (MB/s) of the last window is compared
+    with the window before: if it improved by more than tolerance the
+    concurrency keeps moving in the same direction, otherwise the direction
+    is reversed. at saturation it alternates around the best concurrency
+    '''
+    def __init__(self, start = 4, minimum = 1, maximum = 16, window = 30,
+        tolerance = 0.05):
+        self.concurrency = max(minimum, min(start, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.tolerance = tolerance
+        self.direction = 1
+        self.previous = None
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.window_files = 0
+        self.history = []
+
+    def __repr__(self):
+        return f"<ThroughputController concurrency {self.concurrency}>"
+
+    def add(self, n_bytes, n_files):
+        '''register finished work, returns the (new) concurrency
+        zero work (e.g. a tar whose files all exist) is ignored'''
+        if n_bytes == 0 and n_files == 0: return self.concurrency
+        self.window_bytes += n_bytes
+        self.window_files += n_files
+        now = time.time()
+        seconds = now - self.window_start
+        if seconds < self.window: return self.concurrency
+        mb_per_second = self.window_bytes / 1024**2 / seconds
+        files_per_second = self.window_files / seconds
+        self.history.append((now, self.concurrency, mb_per_second,
+            files_per_second))
+        m = f'{time.ctime()} concurrency {self.concurrency} '
+        m += f'{mb_per_second:.1f} MB/s {files_per_second:.1f} files/s'
+        print(m)
+        if self.previous is not None:
+            change = (mb_per_second - self.previous) / max(self.previous, 1e-9)
+            # no gain from the last step, step back
+            if change <= self.tolerance: self.direction *= -1
+        self._step()
+        self.previous = mb_per_second
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_files = 0
+        return self.concurrency
+
+    def _step(self):
+        c = self.concurrency + self.direction
+        self.concurrency = max(self.minimum, min(c, self.maximum))
+
+def extract_files_threaded(tar_file_path, member_names, output_path,
+    num_threads = 4, check_existing = True, progress = None):
+    '''extract member_names to output_path / tar stem, the members are read
+    in on-disk order with the sidecar index while a thread pool writes the
+    files, at most 4 * num_threads files are held in memory
+    progress    called with the number of bytes of each written file
+    returns (tar_file_path, number of files, number of bytes)
+    '''
+    if check_existing:
+        _, _, member_names = check_whether_files_exist(tar_file_path,
+            member_names, output_path)
+    if not member_names: return tar_file_path, 0, 0
+    output_path = Path(output_path) / Path(tar_file_path).stem
+    index = load_tar_index(tar_file_path)
+    pending = threading.BoundedSemaphore(4 * num_threads)
+    def write(f, data):
+        try:
+            f.parent.mkdir(parents=True, exist_ok=True)
+            with open(f, 'wb') as fout:
+                fout.write(data)
+            if progress is not None: progress(len(data))
+        finally: pending.release()
+    n_files, n_bytes = 0, 0
+    with ThreadPoolExecutor(max_workers = num_threads) as executor:
+        futures = []
+        for name, data in read_members(tar_file_path, member_names, index):
+            pending.acquire()
+            futures.append(executor.submit(write, output_path / name, data))
+            n_files += 1
+            n_bytes += len(data)
+        for future in futures: future.result()
+    return tar_file_path, n_files, n_bytes
+
+class ProgressReporter:
+    '''sends (n_bytes, n_files) of written files to a queue in batches of at
+    least min_bytes or min_seconds'''
+    def __init__(self, queue, min_bytes = 8 * 1024**2, min_seconds = 1.0):
+        self.queue = queue
+        self.min_bytes = min_bytes
+        self.min_seconds = min_seconds
+        self.lock = threading.Lock()
+        self.n_bytes, self.n_files = 0, 0
+        self.last = time.time()
+
+    def __call__(self, n_bytes):
+        with self.lock:
+            self.n_bytes += n_bytes
+            self.n_files += 1
+            if self.n_bytes < self.min_bytes and \
+                time.time() - self.last < self.min_seconds: return
+            self._send()
+
+    def flush(self):
+        with self.lock:
+            if self.n_files: self._send()
+
+    def _send(self):
+        self.queue.put(('progress', self.n_bytes, self.n_files))
+        self.n_bytes, self.n_files = 0, 0
+        self.last = time.time()
+
+_progress_queue = None
+
+def _init_threaded_worker(progress_queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+
+def _threaded_runner(args, output_path, num_threads, check_existing):
+    tar_file_path, member_names = args
+    reporter = ProgressReporter(_progress_queue)
+    try:
+        return extract_files_threaded(tar_file_path, member_names, 
+            output_path, num_threads, check_existing, reporter)
+    finally: reporter.flush()
+
+def extract_files_scheduled(tar_audio_file_dict, output_path, tar_bytes = None,
+    max_workers = 16, start_workers = 4, num_threads = 4, window = 30,
+    check_existing = True):
+    '''extract the members of each tar in tar_audio_file_dict
+    the tars are handled largest first (tar_bytes: {tar_file_path: bytes to
+    read}, default the size of the tar file) by a process pool, the number of
+    tars in flight is adapted to the observed throughput (see
+    ThroughputController) between 1 and max_workers, the workers report the
+    bytes of each written file (in small batches) so throughput is measured
+    while large tars are still running
+    returns the ThroughputController (its history holds the measurements)
+    '''
+    if tar_bytes is None: tar_bytes = {}
+    def size(tar_file_path):
+        n = tar_bytes.get(tar_file_path)
+        if n is not None: return n
+        try: return os.path.getsize(tar_file_path)
+        except OSError: return 0
+    items = sorted(tar_audio_file_dict.items(), key = lambda x: -size(x[0]))
+    total = len(items)
+    controller = ThroughputController(start_workers, 1, max_workers, window)
+    n_gb = sum(size(k) for k, _ in items) / 1024**3
+    print(f'{time.ctime()} extracting from {total} tars, {n_gb:.2f} GB')
+    f = partial(_threaded_runner, output_path = output_path,
+        num_threads = num_threads, check_existing = check_existing)
+    start = time.time()
+    n_done, n_files, n_bytes, active = 0, 0, 0, 0
+    with multiprocessing.Manager() as manager:
+        # progress of the workers and finished tars (from the result callbacks)
+        events = manager.Queue()
+        pool = Pool(processes = max_workers, 
+            initializer = _init_threaded_worker, initargs = (events,))
+        with pool, tqdm(total = total) as bar:
+            while items or active:
+                while items and active < controller.concurrency:
+                    pool.apply_async(f, (items.pop(0),), 
+                        callback = lambda r: events.put(('done', r)),
+                        error_callback = lambda e: events.put(('error', e)))
+                    active += 1
+                event = events.get()
+                if event[0] == 'progress':
+                    controller.add(event[1], event[2])
+                    continue
+                active -= 1
+                if event[0] == 'error': raise event[1]
+                result = event[1]
+                n_done += 1
+                n_files += result[1]
+                n_bytes += result[2]
+                bar.update(1)
+    seconds = time.time() - start
+    m = f'{time.ctime()} extracted {n_files} files, {n_bytes / 1024**3:.2f} GB'
+    m += f' from {n_done} tars in {seconds:.0f} s'
+    print(m)
+    return controller
+
 def extract_files_with_tar_audio_file_dict(tar_audio_file_dict, output_path, 
     verbose = False):
     for tar_file_path, member_names in progressbar(tar_audio_file_dict.items()):
         extract_files(tar_file_path, member_names, output_path, verbose)
 
 def extract_files(tar_file_path, member_names, output_path, verbose = False,
-    check_existing = False):
+    check_existing = False, single_pass = True, use_index = False):
+    '''extract member_names from the tar to output_path / tar stem
+    single_pass     read the tar once front to back and extract the requested
+                    members as they stream past, instead of a getmember
+                    lookup per member
+    use_index       read only the requested members with the sidecar index
+                    (see make_tar_index)
+    '''
     if check_existing:
         all_exist, present_files, missing_files = check_whether_files_exist(
             tar_file_path, member_names, output_path)
@@ -52,11 +252,23 @@ def extract_files(tar_file_path, member_names, output_path, verbose = False,
     stem = Path(tar_file_path).stem
     output_path = Path(output_path) / stem
     output_path.mkdir(parents=True, exist_ok=True)
+    if use_index:
+        return extract_files_with_index(tar_file_path, member_names, 
+            output_path.parent)
+    if single_pass:
+        with tarfile.open(tar_file_path, 'r|') as tar:
+            missing = extract_files_from_tar_single_pass(tar, member_names, 
+                output_path, verbose)
+        if missing: 
+            print(f'{len(missing)} files not found in {tar_file_path}')
+        return tar_file_path
     with tarfile.open(tar_file_path, 'r') as tar:
         extract_files_from_tar(tar, member_names, output_path, verbose)
     return tar_file_path
 
-def list_contents(tar_file_path):
+def list_contents(tar_file_path, use_index = False):
+    if use_index:
+        return list(load_tar_index(tar_file_path)['members'].keys())
     print('listing files from tar:', tar_file_path)
     with tarfile.open(tar_file_path, 'r') as tar:
         fn = tar.getnames()
@@ -78,6 +290,22 @@ def extract_files_from_tar(tar, member_names, output_path, verbose = False):
     for member_name in member_names:
         extract_file_from_tar(tar, member_name, output_path, verbose = False)
 
+def extract_files_from_tar_single_pass(tar, member_names, output_path, 
+    verbose = False):
+    '''walk the tar once in on-disk order and extract the requested members
+    the tar can be opened in stream mode ('r|') so it is read sequentially
+    returns the set of member names that were not found in the tar
+    '''
+    wanted = set(member_names)
+    for member in tar:
+        if not wanted: break
+        if member.name not in wanted: continue
+        if verbose:
+            print(f'extracting {member.name} from {tar} to {output_path}')
+        tar.extract(member, path=output_path, filter = 'data')
+        wanted.discard(member.name)
+    return wanted
+
 
 def check_whether_files_exist(tar_file_path, member_names, output_path):
     stem = Path(tar_file_path).stem
@@ -96,3 +324,107 @@ def check_whether_files_exist(tar_file_path, member_names, output_path):
     return all_exist, present_files, missing_files
     
     
+
+
+# sidecar byte offset index
+
+def tar_index_filename(tar_file_path, index_directory = None):
+    '''the index of split/name.tar is stored as split/name.index.json
+    in index_directory (default locations.tar_index_directory)
+    '''
+    if index_directory is None:
+        index_directory = locations.tar_index_directory
+    tar_file_path = Path(tar_file_path)
+    split = tar_file_path.parent.name
+    return Path(index_directory) / split / f'{tar_file_path.stem}.index.json'
+
+def make_tar_index(tar_file_path, index_directory = None, overwrite = False):
+    '''read the tar headers once and store a sidecar index with for each
+    member: [header offset, data offset, size]
+    the size and mtime of the tar are stored to detect a changed tar
+    '''
+    f = tar_index_filename(tar_file_path, index_directory)
+    if f.exists() and not overwrite:
+        print(f'{f} exists, skipping.')
+        with open(f, encoding='utf-8') as fin:
+            return json_codec.load(fin)
+    stat = os.stat(tar_file_path)
+    members = {}
+    # seekable mode: next() seeks past the member data, only headers are read
+    with tarfile.open(tar_file_path, 'r:') as tar:
+        while True:
+            member = tar.next()
+            if member is None: break
+            if not member.isfile(): continue
+            members[member.name] = [member.offset, member.offset_data, 
+                member.size]
+    index = {'tar_file_path': str(tar_file_path), 'size': stat.st_size,
+        'mtime': stat.st_mtime, 'members': members}
+    f.parent.mkdir(parents=True, exist_ok=True)
+    with open(f, 'w', encoding='utf-8') as fout:
+        json_codec.dump(index, fout)
+    return index
+
+def make_tar_indices(tar_file_paths, index_directory = None, 
+    overwrite = False, num_workers = 6):
+    '''build the sidecar index for each tar with a pool of workers'''
+    f = partial(make_tar_index, index_directory = index_directory,
+        overwrite = overwrite)
+    with Pool(processes=num_workers) as pool:
+        for _ in tqdm(pool.imap_unordered(f, tar_file_paths),
+            total = len(tar_file_paths)):
+            pass
+
+def load_tar_index(tar_file_path, index_directory = None):
+    '''load the sidecar index of a tar, the index is (re)build if it
+    does not exist or the tar changed since it was made
+    '''
+    f = tar_index_filename(tar_file_path, index_directory)
+    if f.exists():
+        with open(f, encoding='utf-8') as fin:
+            index = json_codec.load(fin)
+        stat = os.stat(tar_file_path)
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+            return index
+        print(f'{tar_file_path} changed, rebuilding index {f}')
+    return make_tar_index(tar_file_path, index_directory, overwrite = True)
+
+def read_members(tar_file_path, member_names, index = None):
+    '''yield (member_name, bytes) for the requested members
+    each member is read with a single os.pread at its indexed data offset,
+    members are read in on-disk order
+    '''
+    if index is None:
+        index = load_tar_index(tar_file_path)
+    members = index['members']
+    missing = [name for name in member_names if name not in members]
+    if missing:
+        m = f'{len(missing)} members not found in {tar_file_path}: '
+        m += f'{missing[:3]}'
+        raise ValueError(m)
+    names = sorted(set(member_names), key = lambda name: members[name][1])
+    fd = os.open(tar_file_path, os.O_RDONLY)
+    try:
+        for name in names:
+            _, data_offset, size = members[name]
+            yield name, os.pread(fd, size, data_offset)
+    finally: os.close(fd)
+
+def read_member(tar_file_path, member_name, index = None):
+    '''return the bytes of a single member of a tar'''
+    for _, data in read_members(tar_file_path, [member_name], index):
+        return data
+
+def extract_files_with_index(tar_file_path, member_names, output_path,
+    index = None):
+    '''extract member_names to output_path / tar stem using the sidecar
+    index, only the data of the requested members is read
+    '''
+    stem = Path(tar_file_path).stem
+    output_path = Path(output_path) / stem
+    for name, data in read_members(tar_file_path, member_names, index):
+        f = output_path / name
+        f.parent.mkdir(parents=True, exist_ok=True)
+        with open(f, 'wb') as fout:
+            fout.write(data)
+    return tar_file_path